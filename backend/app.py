@@ -1,88 +1,289 @@
-from flask import Flask, request, jsonify
+import os
+import time
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
+from sqlalchemy import update
 from models import Base, Publication, FloraPublication
-from database import engine, SessionLocal
-from fetch_data import fetch_flora_publications, fetch_combined_publications, get_db_session
-import json
-
-CONFIG_FILE = r"validation-flora\backend\config.json"
+from database import create_schema, get_db_session, SessionLocal
+from publication_query import iter_publications, parse_fields, parse_limit, publication_filters, query_publications
+from response_cache import LRUCache, bump_table_version, get_table_versions
+from search import SEARCH_MODELS, create_search_indexes, search_publications
+from config import Config, load_fetch_config
+from jobs import JobRunner, SOURCE_PARTS
+import fast_json
+import metrics
+from profiling import Profile, profile_requested
+# The matcher (fuzzywuzzy, numpy, rapidfuzz) and the fetchers (requests, xmltodict)
+# are imported by the routes that use them, so workers start without loading them
 
 app = Flask(__name__)
 CORS(app) 
 
-# Create all tables (if they don't already exist)
-Base.metadata.create_all(bind=engine)
+def init_db():
+    # Create all tables and indexes (if they don't already exist)
+    create_schema(Base.metadata)
+    create_search_indexes()
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create missing tables, columns and indexes (`flask --app app init-db`)."""
+    from fetch_data import backfill_normalized_columns, needs_normalized_backfill
+
+    init_db()
+    # Rows stored before the normalized title/DOI columns: without them DOI matching finds nothing
+    with get_db_session() as session:
+        backfill = needs_normalized_backfill(session)
+    if backfill:
+        backfill_normalized_columns()
+    print("Database schema is up to date.")
+
+# Serialized responses of unchanged tables, per URL (see `versioned_json`)
+response_cache = LRUCache(Config.RESPONSE_CACHE_SIZE)
+# Background fetch jobs (see `/fetch_data`)
+job_runner = JobRunner(Config.FETCH_JOB_WORKERS)
+
+PUBLICATION_TABLES = [Publication.__tablename__, FloraPublication.__tablename__]
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_latency(response):
+    # Time until the response is returned; the body of streamed responses is not included
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, route=route,
+                                        method=request.method, status=response.status_code)
+    return response
+
+def _profile_flag():
+    # `?profile=` or the `X-Profile` header, for requests whose URL cannot be changed
+    return request.args.get('profile') or request.headers.get('X-Profile')
+
+@app.before_request
+def start_profile():
+    # Opt-in (see profiling.py); /fetch_data passes the flag on to its job instead
+    flag = _profile_flag()
+    if profile_requested(flag) and request.endpoint != 'fetch_data':
+        g.profile_mode = flag
+        g.profile = Profile(f"{request.method} {request.path}").start()
+
+@app.after_request
+def finish_profile(response):
+    profile = g.pop('profile', None)
+    if profile is None or not profile.active:
+        return response
+    # Streamed bodies are produced later and are not part of the profile
+    if g.profile_mode == 'response':
+        profile.stop(save=False)
+        return Response(profile.summary, mimetype='text/plain')
+    response.headers['X-Profile-File'] = os.path.basename(profile.stop())
+    return response
+
+@app.teardown_request
+def stop_profile(exc):
+    # A request that raised past the error handlers skipped `finish_profile`
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.stop()
+
+def _tagged(response, etag):
+    response.set_etag(etag)
+    # Let browsers keep the payload but revalidate it on every use
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def _versions_etag(session, tables):
+    return '-'.join(str(version) for version in get_table_versions(session, tables))
+
+def versioned_json(session, tables, build):
+    """
+    JSON response of `build()`, tagged with the versions of the tables it reads.
+
+    A request whose `If-None-Match` carries the current tag gets a 304, and an
+    unchanged payload is served from `response_cache` without calling `build`.
+    """
+    etag = _versions_etag(session, tables)
+    if request.if_none_match.contains(etag):
+        return _tagged(Response(status=304), etag)
+    cached = response_cache.get(request.full_path)
+    if cached is None or cached[0] != etag:
+        cached = (etag, fast_json.dumps(build()))
+        response_cache.set(request.full_path, cached)
+    return _tagged(Response(cached[1], mimetype='application/json'), etag)
+
+def versioned_stream(session, tables, items_of):
+    """
+    Streamed JSON array of `items_of(session)`, tagged like `versioned_json`.
+
+    For full listings: the array is encoded chunk by chunk as rows are read, and
+    is not kept in `response_cache`, so memory does not grow with the tables.
+    """
+    etag = _versions_etag(session, tables)
+    if request.if_none_match.contains(etag):
+        return _tagged(Response(status=304), etag)
+    return _tagged(Response(stream_with_context(stream_json_array(items_of)), mimetype='application/json'),
+                   etag)
+
+def stream_json_array(items_of):
+    session = SessionLocal()
+    try:
+        yield from fast_json.iter_json_array(items_of(session))
+    except Exception as e:
+        # The status is already sent, the client sees a truncated array
+        app.logger.error(f"Error while streaming a response: {str(e)}")
+    finally:
+        session.close()
 
 @app.route('/')
 def home():
     return "<h1>Bibliometric data</h1><p>Data is being fetched and stored.</p>"
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Route, fetcher, database and matcher metrics of this process, for Prometheus."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/fetch_data', methods=['GET'])
 def fetch_data():
     """
     Endpoint to trigger data fetching and storing.
-    """
-    with open(CONFIG_FILE, 'r') as f:
-        config = json.load(f)
 
+    The crawl runs as a background job; the response (202) carries the job, whose
+    progress is served by `/api/jobs/<id>`. While a job covering the requested
+    source is queued or running, that job is returned instead of a new one.
+    """
     try:
         source = request.args.get('source', 'all')
-        result = {'message': 'Data fetch initiated successfully', 'details': []}
-
-        if source == 'flora' or source == 'all':
-                # Fetch Flora data
-                fetch_flora_publications(config)
-                result['details'].append('Flora data fetched successfully')
-        if source == 'openalex' or source == 'all':
-                # Fetch OpenAlex and HAL data
-                fetch_combined_publications(config)
-                result['details'].append('OpenAlex and HAL data fetched successfully')
-
-        return jsonify(result)
+        if source not in SOURCE_PARTS:
+            return jsonify({'error': f'Unknown source: {source}'}), 400
+        # Parsed once, re-read when config.json changes
+        config = load_fetch_config(source=source)
+
+        profile = profile_requested(_profile_flag())
+        # By default only changes since the last sync are fetched
+        full = request.args.get('full', '').lower() in ('1', 'true')
+        job, started = job_runner.submit(source, run_fetch_job, source, config, profile, full)
+        result = {
+            'message': 'Data fetch initiated successfully' if started else 'Data fetch already in progress',
+            'job': job.to_dict(),
+            'status_url': f"/api/jobs/{job.id}"
+        }
+        return jsonify(result), 202
     except Exception as e:
         # Log the error for server-side debugging
         app.logger.error(f"Error during data fetch: {str(e)}")
         return jsonify({'error': f'An error occurred: {str(e)}'}), 500
 
+def run_fetch_job(job, source, config, profile=False, full=False):
+    capture = Profile(f"fetch_data-{source}").start() if profile else None
+    try:
+        fetch_job_phases(job, source, config, full)
+    finally:
+        path = capture.stop() if capture is not None else None
+        if path:
+            job.profile = os.path.basename(path)
+
+def fetch_job_phases(job, source, config, full=False):
+    from fetch_data import source_fetchers, sync_sources
+    from match_store import refresh_all_match_results
+
+    # Flora, OpenAlex and HAL are fetched concurrently, and stored by this thread
+    sources = source_fetchers(config, SOURCE_PARTS[source])
+    job.set_phase('fetching ' + ', '.join(sorted(SOURCE_PARTS[source])))
+    sync_sources(sources, progress=job.record, full=full)
+
+    # Rescore stored matches against the newly inserted records
+    job.set_phase('rescoring matches')
+    with get_db_session() as session:
+        refresh_all_match_results(session, workers=Config.MATCH_WORKERS)
+    job.set_phase(None)
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify([job.to_dict() for job in job_runner.jobs()])
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_runner.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found', 'id': job_id}), 404
+    return jsonify(job.to_dict())
+
 @app.route('/api/publications', methods=['GET'])
 def get_publications():
     """
     API endpoint to retrieve publication data.
     You can pass a query parameter `source` with value 'openalex' or 'flora' to filter by source.
     If not provided, you can return both combined or just one source.
+
+    Optional filters: `year`, `type`, `source_name` (part of the journal name) and
+    `isValid` (true/false); `fields=id,title,...` returns only those columns.
+    With `limit` the response is one page, `{publications, next_cursor}`, ordered
+    by (year, id); pass `after=<next_cursor>` for the next page.
     """
     session = SessionLocal()
     try:
         source = request.args.get('source', 'openalex')
-        if source == 'openalex':
-            pubs = (session.query(Publication)
-            .order_by(Publication.year, Publication.id)
-            .all())
-        elif source == 'flora':
-            pubs = session.query(FloraPublication).all()
-        else:
-            # Optionally combine both (here we simply return OpenAlex publications)
-            pubs = (session.query(Publication)
-                    .order_by(Publication.year, Publication.id)
-                    .all())
-        
-        # Convert ORM objects to dictionaries
-        result = []
-        for pub in pubs:
-            result.append({
-                'id': pub.id,
-                'title': pub.title,
-                'doi': pub.doi,
-                'type': pub.type,
-                'source':pub.source,
-                'year': pub.year,
-                'isValid': pub.isValid,
-                'comment': pub.comment
-            })
-        return jsonify(result)
+        # Anything else than 'flora' returns OpenAlex/HAL publications
+        model_class = FloraPublication if source == 'flora' else Publication
+
+        is_valid = request.args.get('isValid')
+        filters = publication_filters(
+            model_class,
+            year=request.args.get('year', type=int),
+            type=request.args.get('type'),
+            source=request.args.get('source_name'),
+            is_valid=None if is_valid is None else is_valid.lower() in ('true', '1', 'yes')
+        )
+        fields = parse_fields(model_class, request.args.get('fields'))
+        limit = parse_limit(request.args.get('limit', type=int))
+
+        after = request.args.get('after')
+        if not limit:
+            # Whole table: stream column tuples straight into the JSON array
+            return versioned_stream(session, [model_class.__tablename__],
+                                    lambda stream_session: iter_publications(stream_session, model_class,
+                                                                             fields, filters, after))
+
+        def build():
+            publications, next_cursor = query_publications(session, model_class, fields, filters,
+                                                           after=after, limit=limit)
+            return {'publications': publications, 'next_cursor': next_cursor}
+
+        return versioned_json(session, [model_class.__tablename__], build)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     finally:
         session.close()
     
+@app.route('/api/publications/search', methods=['GET'])
+def search_publication_titles():
+    """
+    Ranked title search: `q` (all words must match, the last one as a prefix),
+    `source` ('openalex', 'flora' or 'all'), `limit` and `offset`.
+    Returns `{results, next_offset}`.
+    """
+    source = request.args.get('source', 'openalex')
+    if source not in SEARCH_MODELS:
+        return jsonify({'error': f'Unknown source: {source}'}), 400
+    session = SessionLocal()
+    try:
+        limit = request.args.get('limit', 20, type=int)
+        offset = max(0, request.args.get('offset', 0, type=int))
+
+        def build():
+            results, next_offset = search_publications(session, request.args.get('q', ''), source,
+                                                        limit, offset)
+            return {'results': results, 'next_offset': next_offset}
+
+        return versioned_json(session, [model_class.__tablename__ for model_class in SEARCH_MODELS[source]],
+                              build)
+    finally:
+        session.close()
+
 @app.route('/api/publications/<path:pub_id>/validate', methods=['PUT'])
 def update_publication_validation(pub_id):
     with get_db_session() as session:
@@ -98,6 +299,7 @@ def update_publication_validation(pub_id):
             pub.isValid = bool(data.get('isValid', False))
         if 'comment' in data:
             pub.comment = str(data.get('comment', ''))
+        bump_table_version(session, Publication.__tablename__)
 
         return jsonify({
             'success': True, 
@@ -105,107 +307,153 @@ def update_publication_validation(pub_id):
             'id': pub.id
         })
 
-from fuzzywuzzy import fuzz
-from sqlalchemy import func    
+@app.route('/api/publications/validate', methods=['PUT'])
+def update_publications_validation():
+    """
+    Apply many `{id, isValid, comment}` updates in one transaction.
+
+    The body is a list of updates (or `{"updates": [...]}`). Existing ids are
+    updated with one executemany UPDATE; the response gives a status per id:
+    'updated', 'not_found' or 'invalid'.
+    """
+    data = request.json
+    updates = data.get('updates') if isinstance(data, dict) else data
+    if not isinstance(updates, list):
+        return jsonify({'error': 'Expected a list of {id, isValid, comment} updates'}), 400
+
+    results = []
+    rows = {}
+    for change in updates:
+        if not isinstance(change, dict) or not change.get('id') or not ({'isValid', 'comment'} & change.keys()):
+            results.append({'id': change.get('id') if isinstance(change, dict) else None, 'status': 'invalid'})
+            continue
+        # Same conversions as the single-publication endpoint; a later update of an id wins
+        row = rows.setdefault(str(change['id']), {'id': str(change['id'])})
+        if 'isValid' in change:
+            row['isValid'] = bool(change.get('isValid', False))
+        if 'comment' in change:
+            row['comment'] = str(change.get('comment', ''))
+        results.append({'id': row['id']})
+
+    with get_db_session() as session:
+        ids = list(rows)
+        existing = set()
+        for i in range(0, len(ids), 500):
+            existing.update(pub_id for pub_id, in session.query(Publication.id)
+                            .filter(Publication.id.in_(ids[i:i + 500])))
+        found = [row for pub_id, row in rows.items() if pub_id in existing]
+        if found:
+            # ORM bulk UPDATE by primary key: one executemany per set of updated columns
+            session.execute(update(Publication), found)
+            bump_table_version(session, Publication.__tablename__)
+
+    for result in results:
+        if 'status' not in result:
+            result['status'] = 'updated' if result['id'] in existing else 'not_found'
+    return jsonify({'updated': len(found), 'results': results})
+
 @app.route('/api/publications/match', methods=['GET'])
 def match_publications():
+    from match_store import iter_match_results, load_match_results, refresh_match_results, run_key
+
     session = SessionLocal()
     try:
-        # Matching configuration parameters
-        title_threshold = float(request.args.get('title_threshold', 0.8))
-        match_strategy = request.args.get('strategy', 'comprehensive')
-
-        # Fetch Flora publications
-        flora_pubs = session.query(FloraPublication).all()
-
-        matches = []
-        for flora_pub in flora_pubs:
-            # Find matching publications in OpenAlex
-            matching_candidates = find_publication_matches(
-                session, 
-                flora_pub, 
-                title_threshold=title_threshold,
-                strategy=match_strategy
-            )
-            matches.append({
-                'flora_publication': {
-                    'id': flora_pub.id,
-                    'title': flora_pub.title,
-                    'doi': flora_pub.doi,
-                    'source': flora_pub.source,
-                    'year': flora_pub.year
-                },
-                'matching_candidates': matching_candidates
-            })
-        
-        return jsonify(matches)
+        # Matching configuration parameters; the threshold is rounded to 0.05 (see run_key)
+        match_strategy, title_threshold = run_key(request.args.get('strategy', 'comprehensive'),
+                                                  float(request.args.get('title_threshold', 0.8)))
+        # 'batch' scores with score matrices, 'pair' scores one pair at a time. Results
+        # are stored per strategy/threshold and shared by every request, so they
+        # always use the default candidates ('lsh' and `min_overlap` are not applied)
+        scoring = request.args.get('scoring', 'batch')
+        # Never more processes than configured, whatever the client asks for
+        workers = max(1, min(request.args.get('workers', Config.MATCH_WORKERS, type=int),
+                             Config.MATCH_WORKERS))
 
+        options = {
+            'title_threshold': title_threshold,
+            'strategy': match_strategy,
+            'scoring': scoring,
+            'full': request.args.get('refresh') == 'full',
+            'workers': workers
+        }
+
+        if request.args.get('format') == 'ndjson':
+            # One JSON line per Flora record, sent as soon as its page is scored or read
+            stream = lambda: Response(stream_with_context(stream_matches(options)),
+                                      mimetype='application/x-ndjson')
+            if options['full']:
+                return stream()
+            # Tagged like `versioned_stream`: unchanged tables get a 304
+            etag = _versions_etag(session, PUBLICATION_TABLES)
+            if request.if_none_match.contains(etag):
+                return _tagged(Response(status=304), etag)
+            return _tagged(stream(), etag)
+
+        limit = parse_limit(request.args.get('limit', type=int))
+        if not limit:
+            # Every Flora record: refreshed (or rescored) and read back page by page into a JSON array
+            items_of = lambda stream_session: iter_match_results(stream_session, **options)
+            if options['full']:
+                return Response(stream_with_context(stream_json_array(items_of)), mimetype='application/json')
+            # Stored results only change with the publication tables, skip the refresh otherwise
+            return versioned_stream(session, PUBLICATION_TABLES, items_of)
+
+        def build():
+            # Rescore what changed since the last call, then serve the stored results
+            refresh_match_results(session, **options)
+            # Keyset pagination over Flora ids
+            matches = load_match_results(session, title_threshold, match_strategy,
+                                         after=request.args.get('after'), limit=limit)
+            next_cursor = matches[-1]['flora_publication']['id'] if len(matches) == limit else None
+            return {'matches': matches, 'next_cursor': next_cursor}
+
+        if options['full']:
+            return jsonify(build())
+        return versioned_json(session, PUBLICATION_TABLES, build)
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
         session.close()
 
-# Find matching publications across databases
-def find_publication_matches(session, flora_pub, title_threshold=0.8, strategy='comprehensive'):
-    # Base query for OpenAlex publications
-    query = session.query(Publication)
-    matching_pubs = []
-    if strategy =='exact':
-        # Exact DOI match
-        if flora_pub.doi:
-            exact_match = query.filter(Publication.doi == flora_pub.doi).first()
-            if exact_match:
-                matching_pubs.append(publication_to_dict(exact_match))
-    elif strategy == 'fuzzy':
-        # Fuzzy title matching
-        fuzzy_matches = query.all()
-        for pub in fuzzy_matches:
-            title_similarity = fuzz.ratio(
-                flora_pub.title.lower(), 
-                pub.title.lower()
-            )
-            if title_similarity >= (title_threshold * 100):
-                pub_dict = publication_to_dict(pub)
-                pub_dict['similarity'] = title_similarity
-                matching_pubs.append(pub_dict)
-    else:
-        # Combine multiple matching criteria
-        comprehensive_matches = query.filter(
-            # Year within ±1 year
-            func.abs(Publication.year - flora_pub.year) <= 1
-        ).all()
-        for pub in comprehensive_matches:
-            # Check title similarity
-            title_similarity = fuzz.ratio(
-                flora_pub.title.lower(), 
-                pub.title.lower()
-            )
-            # Additional match scoring
-            match_score = 0
-            if title_similarity >= (title_threshold * 100):
-                match_score += 50
-            if flora_pub.doi and pub.doi == flora_pub.doi:
-                match_score += 50
-
-            if match_score > 0:
-                pub_dict = publication_to_dict(pub)
-                pub_dict['similarity'] = title_similarity
-                pub_dict['match_score'] = match_score
-                matching_pubs.append(pub_dict)
-    return matching_pubs
-
-def publication_to_dict(pub):
-    return {
-        'id': pub.id,
-        'title': pub.title,
-        'doi': pub.doi,
-        'type': pub.type,
-        'source': pub.source,
-        'year': pub.year,
-        'isValid': pub.isValid,
-        'comment': pub.comment
-    }
+@app.route('/api/publications/clusters', methods=['GET'])
+def publication_clusters():
+    """
+    Flora, OpenAlex, HAL and WoS records grouped into one cluster per paper.
 
+    With `missing` (comma-separated sources, e.g. `wos,openalex`) only the Flora
+    entries whose cluster lacks one of those sources are returned.
+    """
+    from resolver import flora_coverage, load_source_records, resolve_entities
+
+    session = SessionLocal()
+    try:
+        title_threshold = float(request.args.get('title_threshold', 0.9))
+        clusters = resolve_entities(load_source_records(session), title_threshold)
+        missing = request.args.get('missing')
+        if missing:
+            return jsonify(flora_coverage(clusters, missing.split(',')))
+        return jsonify(clusters)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
+def stream_matches(options):
+    from match_store import iter_match_results
+
+    session = SessionLocal()
+    try:
+        for match in iter_match_results(session, **options):
+            yield fast_json.dumps(match) + b'\n'
+    except Exception as e:
+        app.logger.error(f"Error while streaming matches: {str(e)}")
+        yield fast_json.dumps({'error': str(e)}) + b'\n'
+    finally:
+        session.close()
 
 if __name__ == '__main__':
+    init_db()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,245 @@
+"""
+Matching benchmark on the 2015 corpora in fetchers/Data.
+
+Loads Flora_2015.csv and OpenAlex_2015.csv (and WoS_2015.csv with --with-wos)
+into a scratch database, optionally scaled up with synthetic copies, then times
+each matching strategy/scoring mode and checks its output against DOI ground
+truth. Run from backend/:
+
+    python benchmark.py --scale 1 10 --scoring batch pair
+
+`--check-incremental` also checks that incrementally refreshed stored results
+(match_store.py) equal a full rescore after publication DOIs change upstream.
+"""
+import argparse
+import csv
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models import Base, Publication, FloraPublication, utcnow
+from matcher import find_doi_matches, find_publication_matches, match_flora_publications
+from normalize import add_normalized_fields
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fetchers', 'Data')
+STRATEGIES = ['exact', 'fuzzy', 'comprehensive']
+# 'brute' is the original per-pair scoring without candidate index
+SCORINGS = ['batch', 'pair', 'lsh', 'brute']
+# Synthetic copies are this many years apart, out of reach of the ±1 year window
+COPY_YEAR_SHIFT = 10
+
+
+def read_csv(name):
+    with open(os.path.join(DATA_DIR, name), newline='', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        row['doi'] = row.get('doi') or None
+        row['title'] = row.get('title') or None
+        row['year'] = int(float(row['year'])) if row.get('year') else None
+    return rows
+
+def scaled_copy(record, copy):
+    """
+    Copy `copy` (>= 1) of a record: new id/DOI, year moved away, title words rotated.
+
+    Every source gets the same change, so a copy matches its own counterparts
+    (same DOI, same rotated title) but not the records of other copies.
+    """
+    record = dict(record)
+    record['id'] = f"{record['id']}#{copy}"
+    if record['doi']:
+        record['doi'] = f"{record['doi']}/{copy}"
+    if record['year'] is not None:
+        record['year'] += COPY_YEAR_SHIFT * copy
+    if record['title']:
+        words = record['title'].split()
+        shift = copy % len(words)
+        record['title'] = ' '.join(words[shift:] + words[:shift])
+    return record
+
+def load_corpora(session, scale=1, with_wos=False):
+    """Fill an empty database with the CSV corpora, repeated `scale` times."""
+    sources = [(FloraPublication, read_csv('Flora_2015.csv'), ['id', 'doi', 'title', 'source', 'year']),
+               (Publication, read_csv('OpenAlex_2015.csv'), ['id', 'doi', 'title', 'type', 'source', 'year'])]
+    if with_wos:
+        sources.append((Publication, read_csv('WoS_2015.csv'), ['id', 'doi', 'title', 'type', 'source', 'year']))
+    counts = defaultdict(int)
+    for model_class, rows, columns in sources:
+        seen = set()
+        for copy in range(scale):
+            instances = []
+            for row in rows:
+                record = {column: row.get(column) for column in columns}
+                if copy:
+                    record = scaled_copy(record, copy)
+                if record['id'] in seen:
+                    continue
+                seen.add(record['id'])
+                instances.append(model_class(**add_normalized_fields(record)))
+            session.bulk_save_objects(instances)
+            counts[model_class.__tablename__] += len(instances)
+        session.commit()
+    return dict(counts)
+
+def doi_ground_truth(session):
+    """(Flora id, publication id) pairs sharing a normalized DOI."""
+    return {(flora_id, pub.id) for flora_id, pubs in find_doi_matches(session).items() for pub in pubs}
+
+def run_matching(session, flora_pubs, strategy, scoring, title_threshold, workers):
+    if scoring == 'brute':
+        return [find_publication_matches(session, flora_pub, title_threshold, strategy)
+                for flora_pub in flora_pubs]
+    if scoring == 'lsh' and strategy != 'exact':
+        # Index built from the benchmark data, not the persisted one
+        from lsh_index import LSHCandidateIndex, build_title_lsh
+        pubs = session.query(Publication).order_by(Publication.year, Publication.id).all()
+        index = LSHCandidateIndex(build_title_lsh(session), pubs)
+        doi_matches = find_doi_matches(session)
+        return [find_publication_matches(session, flora_pub, title_threshold, strategy,
+                                         index=index, doi_matches=doi_matches)
+                for flora_pub in flora_pubs]
+    return match_flora_publications(session, flora_pubs, title_threshold, strategy, scoring, workers=workers)
+
+def evaluate(predicted, truth, judged_flora, judged_pubs):
+    """
+    Precision over the predicted pairs whose two records have a DOI, recall over `truth`.
+
+    Pairs with a DOI-less record cannot be judged and are counted separately.
+    """
+    judged = {pair for pair in predicted if pair[0] in judged_flora and pair[1] in judged_pubs}
+    correct = judged & truth
+    return {
+        'predicted': len(predicted),
+        'unjudged': len(predicted) - len(judged),
+        'precision': round(len(correct) / len(judged), 4) if judged else None,
+        'recall': round(len(predicted & truth) / len(truth), 4) if truth else None
+    }
+
+def benchmark(session, strategies, scorings, title_threshold=0.8, workers=1, memory=True):
+    flora_pubs = session.query(FloraPublication).order_by(FloraPublication.id).all()
+    truth = doi_ground_truth(session)
+    judged_flora = {flora_id for flora_id, in session.query(FloraPublication.id)
+                    .filter(FloraPublication.doi_norm.isnot(None))}
+    judged_pubs = {pub_id for pub_id, in session.query(Publication.id)
+                   .filter(Publication.doi_norm.isnot(None))}
+
+    results = []
+    for strategy in strategies:
+        for scoring in scorings:
+            if strategy == 'exact' and scoring != scorings[0]:
+                continue  # exact ignores the scoring mode
+            start = time.perf_counter()
+            matches = run_matching(session, flora_pubs, strategy, scoring, title_threshold, workers)
+            elapsed = time.perf_counter() - start
+
+            peak = None
+            if memory:
+                # Separate traced run: tracemalloc slows allocations down
+                session.expire_all()
+                tracemalloc.start()
+                run_matching(session, flora_pubs, strategy, scoring, title_threshold, workers)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+            predicted = {(flora_pub.id, candidate['id'])
+                         for flora_pub, candidates in zip(flora_pubs, matches)
+                         for candidate in candidates}
+            result = {
+                'strategy': strategy,
+                'scoring': scoring if strategy != 'exact' else '-',
+                'seconds': round(elapsed, 3),
+                'flora_per_second': round(len(flora_pubs) / elapsed, 1) if elapsed else None,
+                'peak_memory_mb': round(peak / 2**20, 1) if peak is not None else None
+            }
+            result.update(evaluate(predicted, truth, judged_flora, judged_pubs))
+            results.append(result)
+            print(f"  {strategy:<13} {result['scoring']:<6} {result['seconds']:>9.3f}s "
+                  f"{result['flora_per_second'] or 0:>10.1f}/s "
+                  f"{result['peak_memory_mb'] if peak is not None else '-':>8} MB  "
+                  f"P={result['precision']} R={result['recall']} "
+                  f"({result['predicted']} pairs, {result['unjudged']} unjudged)")
+    return results
+
+def _stored_pairs(session, strategy, title_threshold):
+    from match_store import load_match_results
+    return {(entry['flora_publication']['id'], json.dumps(candidate, sort_keys=True))
+            for entry in load_match_results(session, title_threshold, strategy)
+            for candidate in entry['matching_candidates']}
+
+def check_incremental(session, strategies, title_threshold=0.8, changed=20):
+    """
+    Store the results of each strategy, change the DOI of `changed` publications
+    matched by DOI (an upstream correction), refresh incrementally and compare
+    with a full rescore. Returns {strategy: pairs that differ}.
+    """
+    from match_store import refresh_match_results
+    for strategy in strategies:
+        refresh_match_results(session, title_threshold, strategy)
+
+    pub_ids = sorted({pub.id for pubs in find_doi_matches(session).values() for pub in pubs})[:changed]
+    now = utcnow()
+    for pub in session.query(Publication).filter(Publication.id.in_(pub_ids)):
+        normalized = add_normalized_fields({'title': pub.title, 'doi': f"{pub.doi}.corrected"})
+        pub.doi, pub.doi_norm, pub.updated_at = normalized['doi'], normalized['doi_norm'], now
+    session.commit()
+
+    differences = {}
+    for strategy in strategies:
+        refresh_match_results(session, title_threshold, strategy)
+        incremental = _stored_pairs(session, strategy, title_threshold)
+        refresh_match_results(session, title_threshold, strategy, full=True)
+        differences[strategy] = len(incremental ^ _stored_pairs(session, strategy, title_threshold))
+        print(f"  incremental {strategy:<13} {differences[strategy]} pairs differ from a full rescore "
+              f"({len(pub_ids)} DOIs changed)")
+    return differences
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark publication matching on the 2015 CSV corpora.")
+    parser.add_argument('--scale', type=int, nargs='+', default=[1],
+                        help="corpus multipliers to run, e.g. 1 10 100")
+    parser.add_argument('--strategy', nargs='+', choices=STRATEGIES, default=STRATEGIES)
+    parser.add_argument('--scoring', nargs='+', choices=SCORINGS, default=['batch', 'pair'])
+    parser.add_argument('--title-threshold', type=float, default=0.8)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--with-wos', action='store_true', help="also load WoS records as candidates")
+    parser.add_argument('--no-memory', action='store_true', help="skip the tracemalloc runs")
+    parser.add_argument('--check-incremental', action='store_true',
+                        help="then check stored-result refreshes after DOI changes (modifies the data)")
+    parser.add_argument('--database', help="SQLAlchemy URL of an empty database (default: scratch SQLite file)")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    report = []
+    for scale in args.scale:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            engine = create_engine(args.database or f"sqlite:///{os.path.join(tmp_dir, 'benchmark.db')}")
+            Base.metadata.create_all(engine)
+            session = sessionmaker(bind=engine)()
+            try:
+                if session.query(FloraPublication).first() or session.query(Publication).first():
+                    raise SystemExit("The benchmark database must be empty")
+                counts = load_corpora(session, scale, args.with_wos)
+                print(f"Scale {scale}x: {counts}")
+                results = benchmark(session, args.strategy, args.scoring, args.title_threshold,
+                                    args.workers, memory=not args.no_memory)
+                entry = {'scale': scale, 'records': counts, 'results': results}
+                if args.check_incremental:
+                    entry['incremental_differences'] = check_incremental(session, args.strategy,
+                                                                         args.title_threshold)
+                report.append(entry)
+            finally:
+                session.close()
+                engine.dispose()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if any(any(entry.get('incremental_differences', {}).values()) for entry in report):
+        raise SystemExit("Incremental refresh differs from a full rescore")
@@ -0,0 +1,92 @@
+"""
+PostgreSQL COPY loader for large backfills (`python fetch_data.py --bulk`).
+
+Records are streamed with COPY FROM STDIN into a temporary staging table, then
+merged into the target table with set-based statements that follow the same
+rules as `fetch_data.upsert_records`. Works with psycopg2 and psycopg 3; other
+databases use `upsert_records` (executemany) instead.
+"""
+import io
+
+from sqlalchemy import text
+from models import utcnow
+
+
+def copy_columns(model_class):
+    """Columns loaded from the fetched records."""
+    return ('id',) + model_class.CONTENT_FIELDS + ('title_norm', 'doi_norm', 'content_hash')
+
+def _copy_value(value):
+    # COPY text format: \N is NULL; backslash, tab and line breaks are escaped
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def _copy(cursor, statement, data):
+    if hasattr(cursor, 'copy_expert'):
+        # psycopg2
+        cursor.copy_expert(statement, io.StringIO(data))
+    else:
+        # psycopg 3
+        with cursor.copy(statement) as copy:
+            copy.write(data)
+
+def copy_records(session, model_class, records):
+    """
+    Store prepared records (deduplicated, with `content_hash`) through COPY.
+
+    Returns (inserted records, updated records), like `upsert_records`. Runs in
+    the session's transaction; the staging table is dropped on commit.
+    """
+    if not records:
+        return [], []
+    table = model_class.__table__
+    preparer = session.get_bind().dialect.identifier_preparer
+    quote = preparer.quote
+    target = preparer.format_table(table)
+    staging = quote(f"staging_{table.name}")
+    columns = copy_columns(model_class)
+    column_list = ', '.join(quote(column) for column in columns)
+
+    connection = session.connection()
+    connection.execute(text(
+        f"CREATE TEMP TABLE IF NOT EXISTS {staging} (LIKE {target} INCLUDING DEFAULTS) ON COMMIT DROP"
+    ))
+    data = ''.join('\t'.join(_copy_value(record.get(column)) for column in columns) + '\n'
+                   for record in records)
+    cursor = connection.connection.cursor()
+    try:
+        _copy(cursor, f"COPY {staging} ({column_list}) FROM STDIN", data)
+    finally:
+        cursor.close()
+
+    now = utcnow()
+    # Rows stored before content hashes existed, with the same content: only the hash is filled
+    same_content = ' AND '.join(f"t.{quote(field)} IS NOT DISTINCT FROM s.{quote(field)}"
+                                for field in model_class.CONTENT_FIELDS)
+    connection.execute(text(
+        f"UPDATE {target} AS t SET content_hash = s.content_hash FROM {staging} AS s "
+        f"WHERE t.id = s.id AND t.content_hash IS NULL AND {same_content}"
+    ))
+    # Changed rows; review fields (isValid, comment) are not written
+    assignments = ', '.join(f"{quote(column)} = s.{quote(column)}" for column in columns if column != 'id')
+    updated_ids = set(connection.execute(text(
+        f"UPDATE {target} AS t SET {assignments}, updated_at = :now FROM {staging} AS s "
+        f"WHERE t.id = s.id AND t.content_hash IS DISTINCT FROM s.content_hash RETURNING t.id"
+    ), {'now': now}).scalars())
+
+    # Python-side column defaults (e.g. isValid, updated_at), which the database does not know
+    defaults = {}
+    for column in table.columns:
+        if column.name not in columns and column.default is not None:
+            defaults[column.name] = now if column.default.is_callable else column.default.arg
+    names = list(defaults)
+    inserted_ids = set(connection.execute(text(
+        f"INSERT INTO {target} ({', '.join([column_list] + [quote(name) for name in names])}) "
+        f"SELECT {', '.join([f's.{quote(column)}' for column in columns] + [f':d{i}' for i in range(len(names))])} "
+        f"FROM {staging} AS s ON CONFLICT (id) DO NOTHING RETURNING id"
+    ), {f'd{i}': defaults[name] for i, name in enumerate(names)}).scalars())
+    connection.execute(text(f"TRUNCATE {staging}"))
+
+    return ([record for record in records if record['id'] in inserted_ids],
+            [record for record in records if record['id'] in updated_ids])
@@ -1,9 +1,47 @@
-from sqlalchemy import create_engine
+from contextlib import contextmanager
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import sessionmaker, scoped_session
 from config import Config
+from metrics import instrument_engine
 
 # Create engine using the URI from the config
 engine = create_engine(Config.SQLALCHEMY_DATABASE_URI)
+instrument_engine(engine)
 
 # Create a scoped session for thread safety
-SessionLocal = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
\ No newline at end of file
+SessionLocal = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+
+@contextmanager
+def get_db_session():
+    """Context manager for database sessions"""
+    session = SessionLocal()
+    try:
+        yield session
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+def create_schema(metadata):
+    """
+    Create missing tables, and columns/indexes added to tables that already exist.
+
+    New columns are added as nullable, without defaults; existing rows keep NULL.
+    """
+    metadata.create_all(bind=engine)
+    inspector = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    conn.execute(text(
+                        f"ALTER TABLE {preparer.format_table(table)} "
+                        f"ADD COLUMN {preparer.format_column(column)} {column.type.compile(engine.dialect)}"
+                    ))
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
\ No newline at end of file
@@ -0,0 +1,36 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # stdlib json is used instead
+    orjson = None
+
+# Array items encoded per chunk written to a streamed response
+CHUNK_ITEMS = 500
+
+
+def dumps(obj):
+    """UTF-8 encoded JSON of `obj`, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def iter_json_array(items, chunk_items=CHUNK_ITEMS):
+    """
+    Encode an iterable as a JSON array, yielding it in byte chunks.
+
+    Only one chunk of items is held at a time, so the items can be streamed
+    from the database without building the whole list.
+    """
+    yield b'['
+    chunk = []
+    first = True
+    for item in items:
+        chunk.append(dumps(item))
+        if len(chunk) >= chunk_items:
+            yield (b'' if first else b',') + b','.join(chunk)
+            chunk = []
+            first = False
+    if chunk:
+        yield (b'' if first else b',') + b','.join(chunk)
+    yield b']'
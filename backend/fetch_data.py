@@ -1,97 +1,423 @@
 from fetchers.base_fetcher import HalAPI, OpenAlexAPI, FloraAPI
-from contextlib import contextmanager
-from models import FloraPublication, Publication
-from database import SessionLocal
-
-
-@contextmanager
-def get_db_session():
-    """Context manager for database sessions"""
-    session = SessionLocal()
-    try:
-        yield session
-        session.commit()
-    except Exception as e:
-        session.rollback()
-        raise e
-    finally:
-        session.close()
-
-def bulk_insert(session, data: list):
-    session.bulk_save_objects(data)
-    session.commit()
-
-def get_existing_ids(session, model_class):
-    existing_ids = session.query(model_class.id).all()
-    return {id[0] for id in existing_ids}
-
-def fetch_and_store_data(model_class, fetcher, normalize_func=None):
+import os
+import queue
+import threading
+import time
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from bulk_load import copy_records
+from models import Base, FloraPublication, Publication, utcnow
+from database import create_schema, get_db_session
+from metrics import DB_ROWS_INSERTED, DB_ROWS_UNCHANGED, DB_ROWS_UPDATED
+from normalize import add_normalized_fields, content_hash
+from response_cache import bump_table_version
+from sync_state import get_watermark, set_watermark
+from config import Config, load_fetch_config
+from profiling import current_profile, profiled, profiled_thread
+
+
+# Records per INSERT statement
+INSERT_BATCH_SIZE = 1000
+# Records stored between commits of a sync
+COMMIT_EVERY = 5000
+# Normalized pages buffered between the fetcher threads and the writer
+QUEUE_PAGES = 8
+# Dialects with INSERT ... ON CONFLICT
+ON_CONFLICT_INSERTS = {
+    'postgresql': postgresql_insert,
+    'sqlite': sqlite_insert
+}
+
+
+def prepare_records(model_class, records):
+    """Records deduplicated by id (first one kept), each with its `content_hash`."""
+    unique = {}
+    for record in records:
+        unique.setdefault(record['id'], record)
+    for record in unique.values():
+        record['content_hash'] = content_hash(record, model_class.CONTENT_FIELDS)
+    return list(unique.values())
+
+def upsert_records(session, model_class, records, batch_size=INSERT_BATCH_SIZE):
+    """
+    Insert new records and update stored ones whose content changed, `batch_size` at a time.
+
+    Each record gets the `content_hash` of its model's CONTENT_FIELDS. New ids are
+    inserted (PostgreSQL and SQLite run INSERT ... ON CONFLICT (id) DO NOTHING
+    RETURNING id; other databases look up the ids of each batch first), then the
+    rest are compared with the stored hashes (see `update_changed_records`).
+    Only the batch is read, never the whole table.
+    Returns (inserted records, updated records); a record repeated within
+    `records` is stored once.
+    """
+    table = model_class.__table__
+    dialect = session.get_bind().dialect.name
+    records = prepare_records(model_class, records)
+
+    inserted, updated = [], []
+    for start in range(0, len(records), batch_size):
+        batch = records[start:start + batch_size]
+        if dialect in ON_CONFLICT_INSERTS:
+            statement = (ON_CONFLICT_INSERTS[dialect](table)
+                         .on_conflict_do_nothing(index_elements=[table.c.id])
+                         .returning(table.c.id))
+            new_ids = set(session.execute(statement, batch).scalars())
+        else:
+            ids = [record['id'] for record in batch]
+            stored = set(session.scalars(select(table.c.id).where(table.c.id.in_(ids))))
+            new = [record for record in batch if record['id'] not in stored]
+            if new:
+                session.execute(table.insert(), new)
+            new_ids = {record['id'] for record in new}
+        inserted.extend(record for record in batch if record['id'] in new_ids)
+        existing = [record for record in batch if record['id'] not in new_ids]
+        if existing:
+            updated.extend(update_changed_records(session, model_class, existing))
+    return inserted, updated
+
+def update_changed_records(session, model_class, records):
+    """
+    Update the stored rows of `records` whose content hash differs, in bulk.
+
+    The content fields, normalized title/DOI, hash and `updated_at` are written;
+    review fields (`isValid`, `comment`) are not. Rows stored before hashes
+    existed only get their hash when their content is the same.
+    Returns the updated records.
+    """
+    fields = model_class.CONTENT_FIELDS
+    by_id = {record['id']: record for record in records}
+    rows = session.execute(select(model_class.id, model_class.content_hash,
+                                  *[getattr(model_class, field) for field in fields])
+                           .where(model_class.id.in_(list(by_id))))
+    changed, hashed = [], []
+    for row in rows:
+        record = by_id[row.id]
+        if row.content_hash == record['content_hash']:
+            continue
+        if row.content_hash is None and content_hash(row._mapping, fields) == record['content_hash']:
+            hashed.append({'id': row.id, 'content_hash': record['content_hash']})
+        else:
+            changed.append(record)
+
+    if hashed:
+        session.execute(update(model_class), hashed)
+    if changed:
+        now = utcnow()
+        columns = ('id',) + fields + ('title_norm', 'doi_norm', 'content_hash')
+        session.execute(update(model_class), [
+            {**{column: record.get(column) for column in columns}, 'updated_at': now}
+            for record in changed
+        ])
+    return changed
+
+class SyncWriter:
+    """
+    Stores normalized pages in one session, the only one writing during a sync.
+
+    Commits every `commit_every` records, together with the table version bumps
+    for the rows inserted or updated since the previous commit. Committed publications
+    are added to the LSH title index in memory; `save_index` writes it once per sync.
+    With `bulk`, PostgreSQL loads pages through COPY (see bulk_load.py).
+    """
+    def __init__(self, session, progress=None, commit_every=COMMIT_EVERY, bulk=False):
+        self.session = session
+        self.progress = progress
+        self.commit_every = commit_every
+        self.bulk = bulk and session.get_bind().dialect.name == 'postgresql'
+        if bulk and not self.bulk:
+            print("COPY bulk loading needs PostgreSQL; storing with executemany instead.")
+        self.fetched = {}
+        self.inserted = {}
+        self.updated = {}
+        # Seconds spent storing each fetcher's records
+        self.seconds = {}
+        self._pending = 0
+        # Model class -> records inserted or updated since the last commit
+        self._new = {}
+        # Persisted LSH title index, loaded at the first commit that stores publications
+        self._lsh = None
+
+    def write(self, name, model_class, records):
+        """Store the new and changed records of one page fetched by `name`."""
+        table = model_class.__tablename__
+        start = time.perf_counter()
+        if self.bulk:
+            new, changed = copy_records(self.session, model_class, prepare_records(model_class, records))
+        else:
+            new, changed = upsert_records(self.session, model_class, records)
+        self.seconds[name] = self.seconds.get(name, 0) + time.perf_counter() - start
+        self.fetched[name] = self.fetched.get(name, 0) + len(records)
+        self.inserted[name] = self.inserted.get(name, 0) + len(new)
+        self.updated[name] = self.updated.get(name, 0) + len(changed)
+        self._new.setdefault(model_class, []).extend(new + changed)
+        self._pending += len(records)
+        DB_ROWS_INSERTED.inc(len(new), table=table)
+        DB_ROWS_UPDATED.inc(len(changed), table=table)
+        DB_ROWS_UNCHANGED.inc(len(records) - len(new) - len(changed), table=table)
+        if self.progress:
+            self.progress(name, len(records), len(new), len(changed))
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def finish(self, name, fetcher):
+        """Store the watermark a completed fetcher reached, with the next commit."""
+        sync_key = getattr(fetcher, 'sync_key', None)
+        if sync_key and fetcher.watermark:
+            set_watermark(self.session, name, sync_key, fetcher.watermark)
+
+    def commit(self):
+        new, self._new, self._pending = self._new, {}, 0
+        for model_class, records in new.items():
+            if records:
+                # Invalidate cached responses in the same transaction
+                bump_table_version(self.session, model_class.__tablename__)
+        self.session.commit()
+
+        # Keep the optional MinHash/LSH title index in step with the table
+        if new.get(Publication) and (self._lsh is not None or os.path.exists(Config.LSH_INDEX_PATH)):
+            from lsh_index import add_title_records, load_title_lsh
+            if self._lsh is None:
+                self._lsh = load_title_lsh()
+            add_title_records(self._lsh, new[Publication])
+
+    def save_index(self):
+        """Write the LSH title index once, if committed publications were added to it."""
+        if self._lsh is not None:
+            self._lsh.save(Config.LSH_INDEX_PATH)
+            self._lsh = None
+
+def _put(out, stop, item):
+    # Waits for room in the queue, unless the writer has stopped
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _fetch_pages(fetcher, model_class, normalize, out, stop, profile=None):
+    """
+    Fetcher thread: put each normalized page on `out`, then a 'done' or 'failed' message.
+
+    `profile` is the caller's running capture (if any), which this thread's profile joins.
     """
-    Generic function to fetch and store data
+    with profiled_thread(profile):
+        try:
+            pages = fetcher.iter_pages() if hasattr(fetcher, 'iter_pages') else [fetcher.fetch_data()]
+            for page in pages:
+                # Normalized title/DOI are added here, off the writer thread
+                records = [add_normalized_fields(record) for record in normalize(page)]
+                if not _put(out, stop, ('page', fetcher, model_class, records)):
+                    return
+            _put(out, stop, ('done', fetcher, model_class, None))
+        except Exception as e:
+            _put(out, stop, ('failed', fetcher, model_class, e))
+        finally:
+            # Cleanup if the fetcher has a logout method
+            if hasattr(fetcher, 'logout') and callable(fetcher.logout):
+                fetcher.logout()
+
+def sync_sources(sources, progress=None, full=False, commit_every=COMMIT_EVERY, bulk=False):
+    """
+    Fetch several sources concurrently and store what they return.
+
+    Each fetcher runs in its own thread (with its own rate limit and concurrency,
+    see LibraryAPI) and hands normalized pages over a bounded queue to this thread,
+    the single writer, so inserts stay serialized on one session. Wall-clock time
+    is about that of the slowest source.
+
+    Fetchers with a `sync_key` only fetch what changed since the watermark of
+    their last complete sync (unless `full`); the new watermark is stored with
+    the fetcher's last records, so a failed fetcher starts again from the old one.
+
+    Args:
+        sources: List of (model_class, fetcher) or (model_class, fetcher, normalize_func)
+        progress: Optional callback progress(fetcher_name, fetched, inserted, updated), called after each page
+        commit_every: Records stored or found unchanged between commits
+        full: Ignore the stored watermarks and fetch everything
+        bulk: Load through COPY into a staging table (PostgreSQL; for large backfills)
+
+    Returns {fetcher name: records fetched}. When a fetcher fails, the others still
+    complete and are stored, then its error is raised.
+    """
+    out = queue.Queue(maxsize=QUEUE_PAGES)
+    stop = threading.Event()
+    # Fetching runs on the fetcher threads: profile them too when this thread is profiled
+    profile = current_profile()
+    failures = []
+    with get_db_session() as session:
+        started = time.perf_counter()
+        writer = SyncWriter(session, progress, commit_every, bulk)
+        threads = []
+        for source in sources:
+            model_class, fetcher = source[:2]
+            normalize = (source[2] if len(source) > 2 else None) or fetcher.normalize_data
+            name = fetcher.__class__.__name__
+            sync_key = getattr(fetcher, 'sync_key', None)
+            if sync_key and not full:
+                fetcher.since = get_watermark(session, name, sync_key)
+                if fetcher.since:
+                    print(f"{name}: fetching changes since the last sync")
+            writer.fetched[name] = writer.inserted[name] = writer.updated[name] = 0
+            threads.append(threading.Thread(target=_fetch_pages, name=f"sync-{name}", daemon=True,
+                                            args=(fetcher, model_class, normalize, out, stop, profile)))
+
+        try:
+            for thread in threads:
+                thread.start()
+            running = len(threads)
+            while running:
+                kind, fetcher, model_class, payload = out.get()
+                name = fetcher.__class__.__name__
+                if kind == 'page':
+                    writer.write(name, model_class, payload)
+                    continue
+                running -= 1
+                if kind == 'done':
+                    writer.finish(name, fetcher)
+                else:
+                    print(f"Fetching from {name} failed: {payload}")
+                    failures.append((name, payload))
+            writer.commit()
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            # After the final commit, or the last successful one if storing failed
+            writer.save_index()
+
+    for name, fetched in writer.fetched.items():
+        inserted, updated = writer.inserted[name], writer.updated[name]
+        seconds = writer.seconds.get(name, 0)
+        print(f"Total records from {name}: {fetched}, stored in {seconds:.1f}s"
+              + (f" ({fetched / seconds:.0f} rows/s)" if seconds else ""))
+        if inserted or updated:
+            print(f"New data stored successfully! Added {inserted} records, updated {updated}, "
+                  f"{fetched - inserted - updated} unchanged")
+        elif fetched:
+            print(f"No new data to store ({fetched} records unchanged).")
+        else:
+            print("No data fetched.")
+    total = sum(writer.fetched.values())
+    elapsed = time.perf_counter() - started
+    print(f"Synced {total} records in {elapsed:.1f}s" + (f" ({total / elapsed:.0f} rows/s)" if elapsed else ""))
+    if len(failures) == 1:
+        raise failures[0][1]
+    if failures:
+        raise RuntimeError("Sync failed for " + ", ".join(f"{name} ({error})" for name, error in failures))
+    return writer.fetched
+
+def fetch_and_store_data(model_class, fetcher, normalize_func=None, progress=None, commit_every=COMMIT_EVERY,
+                         full=False, bulk=False):
+    """
+    Generic function to fetch and store data, page by page
     
+    Each page from `fetcher.iter_pages()` is normalized and inserted before the
+    next one is fetched, so memory is bounded by the page size. The transaction
+    is committed every `commit_every` records; a failed run keeps what was committed.
+
     Args:
         model_class: SQLAlchemy model class to store data in
-        fetcher: Fetcher instance or object with fetch_data method
+        fetcher: Fetcher instance, or object with a fetch_data method (one page)
         normalize_func: Function to normalize data (if None, uses fetcher.normalize_data)
+        progress: Optional callback progress(fetcher_name, fetched, inserted, updated), called after each page
+        commit_every: Records stored or found unchanged between commits
+        full: Ignore the stored watermark and fetch everything (see `sync_sources`)
+        bulk: Load through COPY (PostgreSQL; see bulk_load.py)
+
+    Returns the number of records fetched.
     """
-    # Fetch data
-    data = fetcher.fetch_data()
-    # Normalize data
-    if normalize_func:
-        normalized_data = normalize_func(data)
-    else:
-        normalized_data = fetcher.normalize_data(data)
-    
-    print(f"Total records from {fetcher.__class__.__name__}: {len(normalized_data)}")
+    fetched = sync_sources([(model_class, fetcher, normalize_func)], progress=progress, full=full,
+                           commit_every=commit_every, bulk=bulk)
+    return fetched[fetcher.__class__.__name__]
+
+def source_fetchers(config, parts):
+    """(model class, fetcher) of each part ('flora', 'openalex') of a sync; 'openalex' includes HAL."""
+    sources = []
+    if 'flora' in parts:
+        sources.append((FloraPublication, FloraAPI(config['Flora'])))
+    if 'openalex' in parts:
+        sources.append((Publication, OpenAlexAPI(config["OpenAlex"])))
+        # Fetch and normalize data from Archives Ouvertes
+        sources.append((Publication, HalAPI(config["HAL"])))
+    return sources
+
+def fetch_combined_publications(config, progress=None, full=False, bulk=False):
+    # OpenAlex and HAL are fetched concurrently
+    fetched = sync_sources(source_fetchers(config, {'openalex'}), progress=progress, full=full, bulk=bulk)
+    return sum(fetched.values())
+
+def fetch_flora_publications(config, progress=None, full=False, bulk=False):
+    fetched = sync_sources(source_fetchers(config, {'flora'}), progress=progress, full=full, bulk=bulk)
+    return sum(fetched.values())
 
-    if normalized_data:
+def _missing_normalized(model_class):
+    # Rows with a title/DOI but no normalized value, e.g. stored before these columns existed
+    return or_(and_(model_class.title_norm.is_(None), model_class.title.isnot(None)),
+               and_(model_class.doi_norm.is_(None), model_class.doi.isnot(None)))
+
+def needs_normalized_backfill(session):
+    """Whether some rows still lack `title_norm`/`doi_norm` (see `backfill_normalized_columns`)."""
+    return any(session.query(model_class.id).filter(_missing_normalized(model_class)).first()
+               for model_class in (FloraPublication, Publication))
+
+def backfill_normalized_columns(batch_size=1000):
+    """
+    Fill `title_norm`/`doi_norm` of rows stored before these columns existed.
+
+    Touched rows get a new `updated_at`, so stored match results are rescored.
+    """
+    for model_class in (FloraPublication, Publication):
+        updated = 0
+        last_id = None
         with get_db_session() as session:
-            existing_ids = get_existing_ids(session, model_class)
-            new_data = [record for record in normalized_data if record['id'] not in existing_ids]
-            
-            if new_data:
-                # Convert dictionaries to SQLAlchemy model instances
-                model_instances = [model_class(**record) for record in new_data]
-                
-                # Store only new data in the database
-                bulk_insert(session, model_instances)
-                print(f"New data stored successfully! Added {len(new_data)} records to {model_class.__tablename__}")
-            else:
-                print("No new data to store.")
-    else:
-        print("No data fetched.")
-
-    # Cleanup if the fetcher has a logout method
-    if hasattr(fetcher, 'logout') and callable(fetcher.logout):
-        fetcher.logout()
-        
-    return normalized_data
-
-def fetch_combined_publications(config):
-    openalex_fetcher = OpenAlexAPI(config["OpenAlex"])
-    openalex_data = fetch_and_store_data(Publication, openalex_fetcher)
-
-    # Fetch and normalize data from Archives Ouvertes
-    hal_fetcher = HalAPI(config["HAL"])
-    hal_data = fetch_and_store_data(Publication, hal_fetcher)
-
-    return len(openalex_data) + len(hal_data)
-
-def fetch_flora_publications(config):
-    flora_fetcher = FloraAPI(config['Flora'])
-    flora_fetcher.login()
-    flora_data = fetch_and_store_data(FloraPublication, flora_fetcher)
-    # flora_fetcher.logout()
-    return len(flora_data)
-
-import json
-CONFIG_FILE = r"validation-flora\backend\config.json"
+            while True:
+                query = session.query(model_class).filter(_missing_normalized(model_class))
+                if last_id is not None:
+                    query = query.filter(model_class.id > last_id)
+                rows = query.order_by(model_class.id).limit(batch_size).all()
+                if not rows:
+                    break
+                for row in rows:
+                    normalized = add_normalized_fields({'title': row.title, 'doi': row.doi})
+                    if (row.title_norm, row.doi_norm) != (normalized['title_norm'], normalized['doi_norm']):
+                        row.title_norm = normalized['title_norm']
+                        row.doi_norm = normalized['doi_norm']
+                        row.updated_at = utcnow()
+                        updated += 1
+                session.commit()
+                last_id = rows[-1].id
+            if updated:
+                bump_table_version(session, model_class.__tablename__)
+        print(f"Backfilled normalized columns of {updated} records in {model_class.__tablename__}")
+
+import argparse
 if __name__ == "__main__":
-    # Example usage
-    with open(CONFIG_FILE, 'r') as f:
-        config = json.load(f)
-    
-    # Test fetching Flora data
-    # fetch_flora_publications(config)
+    parser = argparse.ArgumentParser(description="Fetch publications and store them in the database.")
+    parser.add_argument('--backfill', action='store_true',
+                        help="fill the normalized title/DOI columns of existing rows, then exit")
+    parser.add_argument('--full', action='store_true',
+                        help="fetch everything instead of the changes since the last sync")
+    parser.add_argument('--bulk', action='store_true',
+                        help="load through COPY into a staging table (PostgreSQL), for large backfills")
+    parser.add_argument('--profile', action='store_true',
+                        help="save a cProfile of the run to Config.PROFILE_DIR and print the hot functions")
+    args = parser.parse_args()
+
+    with profiled('fetch_data', enabled=args.profile) as profile:
+        create_schema(Base.metadata)
+        if args.backfill:
+            backfill_normalized_columns()
+        else:
+            # Example usage
+            config = load_fetch_config(source='openalex')
+
+            # Test fetching Flora data
+            # fetch_flora_publications(config)
 
-    fetch_combined_publications(config)
+            fetch_combined_publications(config, full=args.full, bulk=args.bulk)
+    if profile is not None and profile.summary:
+        print(profile.summary)
+        print(f"Profile saved to {profile.path}")
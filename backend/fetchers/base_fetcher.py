@@ -1,25 +1,81 @@
 import requests
 from urllib.parse import urlparse
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import xmltodict
+from metrics import FETCHER_BYTES, FETCHER_REQUESTS, FETCHER_SECONDS
 
 class LibraryAPI:
+    # Parallel requests a fetcher may make (config 'CONCURRENCY')
+    DEFAULT_CONCURRENCY = 1
+
     def __init__(self, config):
         self.config = config
         self.base_url = self.config['URL']
+        self.concurrency = int(self.config.get('CONCURRENCY') or self.DEFAULT_CONCURRENCY)
+        # Requests per second to this provider (config 'RATE_LIMIT'; None is unlimited)
+        self.rate_limit = self.config.get('RATE_LIMIT')
+        self._next_request = 0.0
+        self._rate_lock = threading.Lock()
+        # Watermark of the previous sync (None fetches everything), and the one this run reaches
+        self.since = None
+        self.watermark = None
+
+    @property
+    def sync_key(self):
+        """Identifies the query in the sync state; None when the fetcher has no delta sync."""
+        return None
+
+    def advance_watermark(self, value):
+        # Watermarks here are ISO dates, which compare as strings
+        if value and (self.watermark is None or value > self.watermark):
+            self.watermark = value
 
     def fetch_data(self):
         """Placeholder for fetch data; should be implemented by subclasses."""
         raise NotImplementedError("Subclasses must implement this method.")
+
+    def iter_pages(self):
+        """Yield the raw data page by page, each accepted by `normalize_data` (default: one page)."""
+        yield self.fetch_data()
     
     def normalize_data(self, data):
         """Placeholder for normalizing data; should be implemented by subclasses."""
         raise NotImplementedError("Subclasses must implement this method.")
     
+    def wait_for_rate_limit(self):
+        """Space requests of this fetcher (across its threads) `1 / rate_limit` seconds apart."""
+        if not self.rate_limit:
+            return
+        with self._rate_lock:
+            now = time.monotonic()
+            wait = self._next_request - now
+            self._next_request = max(now, self._next_request) + 1 / float(self.rate_limit)
+        if wait > 0:
+            time.sleep(wait)
+
+    def http_get(self, url, **kwargs):
+        """requests.get, rate limited, recording call count, bytes and latency per fetcher class."""
+        fetcher = self.__class__.__name__
+        self.wait_for_rate_limit()
+        start = time.perf_counter()
+        try:
+            response = requests.get(url, **kwargs)
+        except requests.exceptions.RequestException:
+            FETCHER_REQUESTS.inc(fetcher=fetcher, status='error')
+            raise
+        finally:
+            FETCHER_SECONDS.observe(time.perf_counter() - start, fetcher=fetcher)
+        FETCHER_REQUESTS.inc(fetcher=fetcher, status=response.status_code)
+        FETCHER_BYTES.inc(len(response.content), fetcher=fetcher)
+        return response
+
     def run_query(self, url, params, timeout=50):
         """Send a GET request to the provided URL with the given parameters."""
         try:
-            response = requests.get(url, params=params, timeout=timeout)
+            response = self.http_get(url, params=params, timeout=timeout)
             response.raise_for_status()  # Raise an exception for HTTP errors
             xml_data = response.text
             json_data = json.dumps(xmltodict.parse(xml_data), indent=2)
@@ -42,18 +98,22 @@ class LibraryAPI:
     
 
 class FloraAPI(LibraryAPI):
+    # Every how many syncs the known records are fetched again (config 'RECHECK_EVERY'; 0 never)
+    DEFAULT_RECHECK_EVERY = 7
+
     def __init__(self, config):
         super().__init__(config)
         self.params_query = self.config['parameters_query']
         self.params_record = self.config['parameters_record']
         self.session_id = None
         self.batch_size = 200
+        self.recheck_every = int(self.config.get('RECHECK_EVERY', self.DEFAULT_RECHECK_EVERY))
 
     def login(self):
         USER = self.config['USER']
         PASSWORD = self.config['PASSWORD']
         login_url = f'{self.base_url}?method=login&code={USER}&password={PASSWORD}'
-        response = requests.get(login_url)
+        response = self.http_get(login_url)
         if response.ok:
             self.session_id = response.text.split('apiSession>')[1].split('</')[0]
             print(f"SESSION_ID: {self.session_id}")
@@ -65,28 +125,60 @@ class FloraAPI(LibraryAPI):
     def logout(self):
         if self.session_id:
             logout_url = f'{self.base_url}?method=logout&apiSession={self.session_id}'
-            requests.get(logout_url)
+            self.http_get(logout_url)
             print("Logged out.")
         else:
             print("No session to log out.")
 
+    @property
+    def sync_key(self):
+        return f"{self.params_query.get('tableName')}:{self.params_query.get('query')}"
+
     def fetch_data(self):
+        return [response for page in self.iter_pages() for response in page]
+
+    def iter_pages(self):
+        """
+        Yield the detailed records one batch response (`batch_size` ids) at a time.
+
+        Flora has no modification date to filter on: the watermark holds the record
+        ids already fetched, and only the other ids are fetched in detail. Every
+        `recheck_every` syncs all records are fetched again, so corrections made in
+        Flora reach the table (unchanged ones are skipped by their content hash).
+        """
         # Ensure we are logged in before fetching data
         if not self.session_id:
             self.session_id = self.login()
             if not self.session_id:
                 print("Unable to login, aborting fetch_data.")
-                return {}
+                return
         # Step 1: Fetch all IDs
         record_ids = self.fetch_ids()
         if not record_ids:
             print("No IDs fetched.")
-            return {}
+            return
         print(f"Total results from Flora: {len(record_ids)}")
-        
+        state = json.loads(self.since) if self.since else {}
+        if isinstance(state, list):
+            # Watermark stored as a plain id list, before rechecks
+            state = {'ids': state}
+        seen = set(state.get('ids', ()))
+        # Syncs since all records were last fetched
+        runs = state.get('runs', 0) + 1
+        if not seen:
+            runs = 0
+        elif self.recheck_every and runs >= self.recheck_every:
+            print(f"Fetching all records again to pick up corrections (every {self.recheck_every} syncs)")
+            runs = 0
+        else:
+            record_ids = [record_id for record_id in record_ids if record_id not in seen]
+            print(f"New since the last sync: {len(record_ids)}")
+
         # Step 2: Fetch detailed records
-        records = self.fetch_records_in_batches(record_ids)
-        return records
+        for batch, data in self.iter_records_in_batches(record_ids):
+            seen.update(batch)
+            yield [data]
+        self.watermark = json.dumps({'ids': sorted(seen), 'runs': runs})
     
     def fetch_ids(self):
         try:
@@ -99,8 +191,10 @@ class FloraAPI(LibraryAPI):
             return []
     
     def fetch_records_in_batches(self, record_ids):
+        return [data for _, data in self.iter_records_in_batches(record_ids)]
+
+    def iter_records_in_batches(self, record_ids):
         batch_size= self.batch_size
-        all_records = []
         for i in range(0, len(record_ids), batch_size):
             batch = record_ids[i:i + batch_size]
             record_id_params = "&".join([f"recordId={record_id}" for record_id in batch])
@@ -108,13 +202,15 @@ class FloraAPI(LibraryAPI):
             url = f"{self.base_url}?apiSession={self.session_id}&{record_id_params}"
             try:
                 data = self.run_query(url, self.params_record)
-                all_records.append(data)
             except requests.exceptions.RequestException as e:
                 print(f"Error fetching batch {i // batch_size + 1}: {e}")
             except Exception as e:
                 print(f"Unexpected error fetching batch {i // batch_size + 1}: {e}")
                 # return []
-        return all_records
+            else:
+                # run_query returns None when the request failed
+                if data is not None:
+                    yield batch, data
     
     def normalize_data(self, data):
         normalize_data = []
@@ -158,26 +254,46 @@ class OpenAlexAPI(LibraryAPI):
         self.institution_id = self.config['ROR']
         self.year = self.config['PUBLICATION_YEAR']
         self.per_page = self.config['PER_PAGE']
+        self.api_key = self.config.get('API_KEY')
+
+    @property
+    def sync_key(self):
+        # The from_updated_date filter needs an OpenAlex API key; without one every sync is full
+        if not self.api_key:
+            return None
+        return f"{self.institution_id}:{self.year}"
 
     def fetch_data(self):
+        return [item for page in self.iter_pages() for item in page]
+
+    def iter_pages(self):
+        """Yield the works one API page (`PER_PAGE` results) at a time, changed since `since` if set."""
         params = {
         # "filter": f"authorships.institutions.lineage:{institution_id},publication_year:{year}",
         "filter": f"institutions.ror:{self.institution_id},publication_year:{self.year}",
         "per-page": self.per_page  
         }
+        if self.api_key:
+            params["api_key"] = self.api_key
+        if self.since:
+            params["filter"] += f",from_updated_date:{self.since}"
+        self.watermark = self.since
         cursor = "*"
-        all_results = []
+        total = 0
         while cursor:
             params["cursor"] = cursor
-            response = requests.get(self.base_url, params=params)
+            response = self.http_get(self.base_url, params=params)
             if response.status_code != 200:
-                return "Failed to fetch data", response.status_code
+                raise requests.exceptions.HTTPError(
+                    f"Failed to fetch OpenAlex data: HTTP {response.status_code}", response=response)
             data = response.json()
             this_page_results = data['results']
-            all_results.extend(this_page_results)
+            total += len(this_page_results)
+            for item in this_page_results:
+                self.advance_watermark(item.get('updated_date'))
+            yield this_page_results
             cursor = data["meta"]["next_cursor"]
-        print(f"Total results OpenAlex: {len(all_results)}")
-        return all_results
+        print(f"Total results OpenAlex: {total}")
     
     def normalize_data(self, data):
         return [
@@ -193,6 +309,9 @@ class OpenAlexAPI(LibraryAPI):
         ]
 
 class HalAPI(LibraryAPI):
+    # One metadata request per document, made in parallel
+    DEFAULT_CONCURRENCY = 4
+
     def __init__(self, config):
         super().__init__(config)
         self.query = self.config['query']
@@ -201,30 +320,44 @@ class HalAPI(LibraryAPI):
         self.wt = self.config['write_type']
         self.sort = self.config['sort']
 
-    def fetch_data(self):    
+    @property
+    def sync_key(self):
+        return f"{self.query}:{self.year}"
+
+    def fetch_data(self):
+        return [record for page in self.iter_pages() for record in page]
+
+    def iter_pages(self):
+        """Yield the metadata records one search page (`row` documents) at a time, modified since `since` if set."""
         cursor_mark = "*"
         has_more = True
+        filters = [f'submittedDateY_i:{self.year}']
+        if self.since:
+            filters.append(f'modifiedDate_tdate:[{self.since} TO *]')
+        self.watermark = self.since
 
-        all_results = []
-        while has_more:
-            params = {
-                'q': self.query,
-                'rows': self.rows,
-                'cursorMark': cursor_mark,
-                'wt': self.wt,
-                'fq': f'submittedDateY_i:{self.year}',
-                'sort': self.sort 
-            }
-            response = requests.get(self.base_url, params=params)
-            if response.status_code == 200:
+        # Metadata of a page's documents is fetched `concurrency` requests at a time
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='hal-metadata') as pool:
+            while has_more:
+                params = {
+                    'q': self.query,
+                    'rows': self.rows,
+                    'cursorMark': cursor_mark,
+                    'wt': self.wt,
+                    'fq': filters,
+                    'fl': 'uri_s,modifiedDate_tdate',
+                    'sort': self.sort 
+                }
+                response = self.http_get(self.base_url, params=params)
+                if response.status_code != 200:
+                    raise requests.exceptions.HTTPError(
+                        f"Failed to fetch HAL data: HTTP {response.status_code}", response=response)
                 data = response.json()
-                for doc in data['response']['docs']:
+                docs = data['response']['docs']
+                for doc in docs:
+                    self.advance_watermark(doc.get('modifiedDate_tdate'))
                     doc['metadata_url'] = doc['uri_s'] + '/metadata'
-                    xml_data = requests.get(doc['metadata_url'])
-                    json_data = json.loads(json.dumps(xmltodict.parse(xml_data.content), indent=2))
-
-                    all_results.append(json_data)
-
+                yield list(pool.map(self.fetch_metadata, docs))
 
                 next_cursor_mark = data['nextCursorMark']
                 if cursor_mark == next_cursor_mark:
@@ -232,7 +365,10 @@ class HalAPI(LibraryAPI):
                 else:
                     cursor_mark = next_cursor_mark
         print(f"Total results from Archives Ouvertes: {data['response']['numFound']}")
-        return all_results
+
+    def fetch_metadata(self, doc):
+        xml_data = self.http_get(doc['metadata_url'])
+        return json.loads(json.dumps(xmltodict.parse(xml_data.content), indent=2))
     
     def normalize_data(self, data):
         id_keys = ['TEI', 'text', 'body', 'listBibl', 'biblFull', 'publicationStmt', 'idno']
@@ -0,0 +1,120 @@
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# What each `/fetch_data?source=...` value crawls
+SOURCE_PARTS = {
+    'flora': {'flora'},
+    'openalex': {'openalex'},
+    'all': {'flora', 'openalex'}
+}
+# Finished jobs kept for the status API
+MAX_FINISHED_JOBS = 50
+
+
+class Job:
+    """State of one background fetch, updated by the worker thread."""
+    def __init__(self, source):
+        self.id = uuid.uuid4().hex
+        self.source = source
+        self.status = 'queued'
+        self.phase = None
+        self.fetched = {}
+        self.inserted = {}
+        self.updated = {}
+        self.error = None
+        # File name of the job's profile, when one was requested (see profiling.py)
+        self.profile = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        return self.status in ('queued', 'running')
+
+    def set_phase(self, phase):
+        with self._lock:
+            self.phase = phase
+
+    def record(self, name, fetched, inserted, updated=0):
+        """Progress callback of `sync_sources` (records per fetcher)."""
+        with self._lock:
+            self.fetched[name] = self.fetched.get(name, 0) + fetched
+            self.inserted[name] = self.inserted.get(name, 0) + inserted
+            self.updated[name] = self.updated.get(name, 0) + updated
+
+    def to_dict(self):
+        with self._lock:
+            end = self.finished_at or time.time()
+            return {
+                'id': self.id,
+                'source': self.source,
+                'status': self.status,
+                'phase': self.phase,
+                'records_fetched': dict(self.fetched),
+                'records_inserted': dict(self.inserted),
+                'records_updated': dict(self.updated),
+                'records_unchanged': {name: fetched - self.inserted.get(name, 0) - self.updated.get(name, 0)
+                                      for name, fetched in self.fetched.items()},
+                'elapsed': round(end - self.started_at, 1) if self.started_at else 0.0,
+                'error': self.error,
+                'profile': self.profile
+            }
+
+
+class JobRunner:
+    """
+    Runs fetch jobs on a small local thread pool.
+
+    A job for a source that a queued/running job already covers (e.g. 'flora'
+    while 'all' runs) is not started again; `submit` returns the existing job.
+    Jobs live in this process only.
+    """
+    def __init__(self, max_workers=1):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fetch-job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, source, target, *args):
+        """Start `target(job, *args)` for `source`; returns (job, started)."""
+        parts = SOURCE_PARTS[source]
+        with self._lock:
+            for job in self._jobs.values():
+                if job.active and parts <= SOURCE_PARTS[job.source]:
+                    return job, False
+            job = Job(source)
+            self._jobs[job.id] = job
+            self._prune()
+        self._executor.submit(self._run, job, target, args)
+        return job, True
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda job: job.submitted_at, reverse=True)
+
+    def _run(self, job, target, args):
+        job.status = 'running'
+        job.started_at = time.time()
+        try:
+            target(job, *args)
+            job.status = 'done'
+        except Exception as e:
+            traceback.print_exc()
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            job.finished_at = time.time()
+
+    def _prune(self):
+        finished = sorted((job for job in self._jobs.values() if not job.active),
+                          key=lambda job: job.submitted_at)
+        for job in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job.id]
@@ -0,0 +1,356 @@
+import threading
+import zlib
+from contextlib import contextmanager
+
+from sqlalchemy import func, select, text
+from models import Publication, FloraPublication, MatchResult, MatchRun, utcnow
+from matcher import find_doi_matches, match_flora_publications, scoring_pool
+from publication_query import PUBLICATION_FIELDS
+
+# Ids per IN (...) clause when deleting stale results
+DELETE_CHUNK = 500
+# Flora records scored/read per page when streaming or paginating results
+PAGE_SIZE = 200
+# Strategies that can be stored, and title thresholds rounded to 1/THRESHOLD_STEPS,
+# so requests cannot create an unbounded number of runs to rescore after each fetch
+STRATEGIES = ('exact', 'fuzzy', 'comprehensive')
+THRESHOLD_STEPS = 20
+
+# (strategy, threshold) -> lock held while that run's results are rewritten, so
+# two refreshes of a run (a match request and a fetch job) never overlap. On
+# PostgreSQL an advisory lock also covers the other server processes.
+_run_locks = {}
+_run_locks_guard = threading.Lock()
+
+
+def run_key(strategy, title_threshold):
+    """
+    (strategy, threshold) of the stored run serving a request; the threshold is
+    rounded to the nearest 0.05. Raises ValueError for anything else.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown strategy: {strategy} (allowed: {', '.join(STRATEGIES)})")
+    if not 0 <= title_threshold <= 1:
+        raise ValueError(f"Invalid title_threshold: {title_threshold} (must be between 0 and 1)")
+    return strategy, round(title_threshold * THRESHOLD_STEPS) / THRESHOLD_STEPS
+
+@contextmanager
+def _run_lock(session, strategy, title_threshold):
+    with _run_locks_guard:
+        lock = _run_locks.setdefault((strategy, title_threshold), threading.Lock())
+    with lock:
+        bind = session.get_bind()
+        if bind.dialect.name != 'postgresql':
+            yield
+            return
+        key = zlib.crc32(f"match_run:{strategy}:{title_threshold!r}".encode())
+        # Session-level lock on a connection of its own: the refresh commits page by page
+        with bind.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(text("SELECT pg_advisory_lock(:key)"), {'key': key})
+            try:
+                yield
+            finally:
+                connection.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': key})
+
+def _current_run(session, strategy, title_threshold):
+    # Re-read: another thread may have stored the run while this one waited for the lock
+    return session.get(MatchRun, (strategy, title_threshold), populate_existing=True)
+
+def _scoring(scoring):
+    # Stored results are served to every request of a strategy/threshold, so they
+    # are always built from the default candidates: 'batch' or 'pair' scoring
+    # (same results), never the approximate LSH index
+    return 'pair' if scoring == 'pair' else 'batch'
+
+def _scoring_pool(strategy, scoring, workers):
+    # One process pool per run; exact matching and pair scoring do not use one
+    return scoring_pool(workers if strategy != 'exact' and _scoring(scoring) == 'batch' else 1)
+
+def _run_filter(query, strategy, title_threshold):
+    return query.filter(MatchResult.strategy == strategy,
+                        MatchResult.title_threshold == title_threshold)
+
+def _delete_results(session, strategy, title_threshold, column, ids):
+    ids = list(ids)
+    for i in range(0, len(ids), DELETE_CHUNK):
+        (_run_filter(session.query(MatchResult), strategy, title_threshold)
+         .filter(column.in_(ids[i:i + DELETE_CHUNK]))
+         .delete(synchronize_session=False))
+
+def _stored_flora_ids(session, strategy, title_threshold, candidate_ids):
+    # Flora ids with a stored result on one of `candidate_ids`
+    candidate_ids = list(candidate_ids)
+    flora_ids = set()
+    for i in range(0, len(candidate_ids), DELETE_CHUNK):
+        flora_ids.update(flora_id for flora_id, in
+                         _run_filter(session.query(MatchResult.flora_id), strategy, title_threshold)
+                         .filter(MatchResult.candidate_id.in_(candidate_ids[i:i + DELETE_CHUNK])))
+    return flora_ids
+
+def _store_results(session, strategy, title_threshold, flora_pubs, all_candidates):
+    session.bulk_save_objects([
+        MatchResult(
+            strategy=strategy,
+            title_threshold=title_threshold,
+            flora_id=flora_pub.id,
+            candidate_id=candidate['id'],
+            similarity=candidate.get('similarity'),
+            match_score=candidate.get('match_score')
+        )
+        for flora_pub, candidates in zip(flora_pubs, all_candidates)
+        for candidate in candidates
+    ])
+
+def _match_entry(flora_pub, candidates):
+    return {
+        'flora_publication': {
+            'id': flora_pub.id,
+            'title': flora_pub.title,
+            'doi': flora_pub.doi,
+            'source': flora_pub.source,
+            'year': flora_pub.year
+        },
+        'matching_candidates': candidates
+    }
+
+def _flora_page(session, after=None, limit=None):
+    query = session.query(FloraPublication).order_by(FloraPublication.id)
+    if after is not None:
+        query = query.filter(FloraPublication.id > after)
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+def _flora_rows(session, after=None, limit=None):
+    # Column rows (with attribute access) for reading stored results
+    stmt = (select(FloraPublication.id, FloraPublication.title, FloraPublication.doi,
+                   FloraPublication.source, FloraPublication.year)
+            .order_by(FloraPublication.id))
+    if after is not None:
+        stmt = stmt.where(FloraPublication.id > after)
+    if limit:
+        stmt = stmt.limit(limit)
+    return session.execute(stmt).all()
+
+def _watermarks(session):
+    # Read before scoring so rows inserted meanwhile are picked up next time. Rows
+    # up to these are all scored by the run: ingestion has a single writer per
+    # table (one fetch job at a time, see Config.FETCH_JOB_WORKERS), which stamps
+    # `updated_at` and commits batches in order, so a row committed later always
+    # has a later `updated_at`.
+    return (session.query(func.max(FloraPublication.updated_at)).scalar(),
+            session.query(func.max(Publication.updated_at)).scalar())
+
+def _save_run(session, strategy, title_threshold, watermarks):
+    run = session.get(MatchRun, (strategy, title_threshold))
+    if run is None:
+        run = MatchRun(strategy=strategy, title_threshold=title_threshold)
+        session.add(run)
+    run.flora_watermark, run.publication_watermark = watermarks
+    run.computed_at = utcnow()
+    session.commit()
+
+def _rescore_all(session, title_threshold, strategy, scoring, workers, doi_matches,
+                 page_size=PAGE_SIZE):
+    """
+    Replace the stored results of a strategy/threshold, one page of Flora records at a time.
+
+    Each page is scored, stored and committed before its entries are yielded. The run
+    is dropped first, so an interrupted rescore is started over by the next call.
+    """
+    (session.query(MatchRun)
+     .filter(MatchRun.strategy == strategy, MatchRun.title_threshold == title_threshold)
+     .delete())
+    _run_filter(session.query(MatchResult), strategy, title_threshold).delete(synchronize_session=False)
+    publications = None
+    if strategy != 'exact':
+        publications = (session.query(Publication)
+                        .order_by(Publication.year, Publication.id)
+                        .all())
+    # Keep the loaded publications usable across the per-page commits
+    expire_on_commit, session.expire_on_commit = session.expire_on_commit, False
+    try:
+        with _scoring_pool(strategy, scoring, workers) as pool:
+            after = None
+            while True:
+                flora_pubs = _flora_page(session, after, page_size)
+                if not flora_pubs:
+                    break
+                all_candidates = match_flora_publications(session, flora_pubs, title_threshold, strategy,
+                                                          _scoring(scoring), None, doi_matches,
+                                                          publications=publications, workers=workers,
+                                                          pool=pool)
+                _store_results(session, strategy, title_threshold, flora_pubs, all_candidates)
+                session.commit()
+                for flora_pub, candidates in zip(flora_pubs, all_candidates):
+                    yield _match_entry(flora_pub, candidates)
+                after = flora_pubs[-1].id
+    finally:
+        session.expire_on_commit = expire_on_commit
+
+def _changed_since(session, model_class, watermark):
+    query = session.query(model_class)
+    if watermark is not None:
+        query = query.filter(model_class.updated_at > watermark)
+    else:
+        query = query.filter(model_class.updated_at.isnot(None))
+    return query.order_by(model_class.year, model_class.id).all()
+
+def refresh_match_results(session, title_threshold=0.8, strategy='comprehensive',
+                          scoring='batch', full=False, workers=1):
+    """
+    Bring `match_results` up to date for one strategy/threshold.
+
+    The first run (or `full=True`) scores every Flora publication. Later runs only
+    rescore Flora records inserted/changed since the last run against all
+    publications, and the remaining Flora records against publications
+    inserted/changed since then. Returns the number of Flora and OpenAlex/HAL
+    records that were rescored. Refreshes of the same strategy/threshold run
+    one at a time. `scoring` is 'batch' or 'pair'; stored results never use the
+    LSH index or a custom n-gram overlap, which could miss candidates.
+    """
+    with _run_lock(session, strategy, title_threshold):
+        return _refresh_run(session, _current_run(session, strategy, title_threshold), title_threshold,
+                            strategy, scoring, full, workers)
+
+def _refresh_run(session, run, title_threshold, strategy, scoring, full, workers):
+    watermarks = _watermarks(session)
+    if run is not None and not full and watermarks == (run.flora_watermark, run.publication_watermark):
+        # Nothing inserted or changed since the last run
+        return {'flora': 0, 'publications': 0}
+    doi_matches = find_doi_matches(session)
+
+    if run is None or full:
+        rescored = sum(1 for _ in _rescore_all(session, title_threshold, strategy, scoring,
+                                               workers, doi_matches))
+        _save_run(session, strategy, title_threshold, watermarks)
+        return {'flora': rescored, 'publications': 0}
+
+    changed_flora = _changed_since(session, FloraPublication, run.flora_watermark)
+    changed_pubs = _changed_since(session, Publication, run.publication_watermark)
+    changed_pub_ids = {pub.id for pub in changed_pubs}
+    changed_flora_ids = {flora_pub.id for flora_pub in changed_flora}
+
+    if strategy == 'exact' and changed_pub_ids:
+        # The first DOI hit of a Flora record can change with a new publication, and
+        # a stored hit goes away when the publication's DOI changed upstream
+        changed_flora_ids.update(flora_id for flora_id, pubs in doi_matches.items()
+                                 if any(pub.id in changed_pub_ids for pub in pubs))
+        changed_flora_ids.update(_stored_flora_ids(session, strategy, title_threshold, changed_pub_ids))
+        changed_flora = (session.query(FloraPublication)
+                         .filter(FloraPublication.id.in_(changed_flora_ids))
+                         .order_by(FloraPublication.id)
+                         .all()) if changed_flora_ids else []
+
+    # Drop stale results first, then rescore changed Flora records against every
+    # publication and the other Flora records against changed publications only
+    _delete_results(session, strategy, title_threshold, MatchResult.flora_id, changed_flora_ids)
+    if strategy != 'exact':
+        _delete_results(session, strategy, title_threshold, MatchResult.candidate_id, changed_pub_ids)
+
+    with _scoring_pool(strategy, scoring, workers) as pool:
+        if changed_flora:
+            all_candidates = match_flora_publications(session, changed_flora, title_threshold, strategy,
+                                                      _scoring(scoring), None, doi_matches,
+                                                      workers=workers, pool=pool)
+            _store_results(session, strategy, title_threshold, changed_flora, all_candidates)
+
+        if changed_pubs and strategy != 'exact':
+            unchanged_flora = [flora_pub for flora_pub in
+                               session.query(FloraPublication).order_by(FloraPublication.id)
+                               if flora_pub.id not in changed_flora_ids]
+            all_candidates = match_flora_publications(session, unchanged_flora, title_threshold, strategy,
+                                                      _scoring(scoring), None, doi_matches,
+                                                      publications=changed_pubs, workers=workers,
+                                                      pool=pool)
+            _store_results(session, strategy, title_threshold, unchanged_flora, all_candidates)
+
+    _save_run(session, strategy, title_threshold, watermarks)
+    return {'flora': len(changed_flora), 'publications': len(changed_pubs)}
+
+def refresh_all_match_results(session, workers=1):
+    """
+    Rescore every strategy/threshold that already has stored results, e.g. after a fetch.
+
+    Runs stored before `run_key` existed with any other key are deleted instead.
+    """
+    runs = []
+    for strategy, title_threshold in session.query(MatchRun.strategy, MatchRun.title_threshold).all():
+        try:
+            valid = run_key(strategy, title_threshold) == (strategy, title_threshold)
+        except ValueError:
+            valid = False
+        if valid:
+            runs.append((strategy, title_threshold))
+            continue
+        with _run_lock(session, strategy, title_threshold):
+            _run_filter(session.query(MatchResult), strategy, title_threshold).delete(synchronize_session=False)
+            (session.query(MatchRun)
+             .filter(MatchRun.strategy == strategy, MatchRun.title_threshold == title_threshold)
+             .delete())
+            session.commit()
+    for strategy, title_threshold in runs:
+        refresh_match_results(session, title_threshold, strategy, workers=workers)
+    return len(runs)
+
+def load_match_results(session, title_threshold=0.8, strategy='comprehensive', after=None, limit=None):
+    """
+    Stored matches in the `/api/publications/match` response format.
+
+    `after`/`limit` return one page of Flora records ordered by id (keyset pagination).
+    """
+    flora_pubs = _flora_rows(session, after, limit)
+    if not flora_pubs:
+        return []
+
+    # Plain column tuples: no ORM objects are built for the candidates
+    fields = PUBLICATION_FIELDS[Publication]
+    stmt = (select(MatchResult.flora_id, MatchResult.similarity, MatchResult.match_score,
+                   *[getattr(Publication, field) for field in fields])
+            .join(Publication, Publication.id == MatchResult.candidate_id)
+            .where(MatchResult.strategy == strategy,
+                   MatchResult.title_threshold == title_threshold,
+                   MatchResult.flora_id <= flora_pubs[-1].id)
+            .order_by(MatchResult.flora_id, Publication.year, Publication.id))
+    if after is not None:
+        stmt = stmt.where(MatchResult.flora_id > after)
+
+    candidates_by_flora = {}
+    for flora_id, similarity, match_score, *values in session.execute(stmt):
+        pub_dict = dict(zip(fields, values))
+        if strategy != 'exact':
+            pub_dict['similarity'] = similarity
+        if strategy not in ('exact', 'fuzzy'):
+            pub_dict['match_score'] = match_score
+        candidates_by_flora.setdefault(flora_id, []).append(pub_dict)
+
+    return [_match_entry(flora_pub, candidates_by_flora.get(flora_pub.id, []))
+            for flora_pub in flora_pubs]
+
+def iter_match_results(session, title_threshold=0.8, strategy='comprehensive',
+                       scoring='batch', full=False, workers=1, page_size=PAGE_SIZE):
+    """
+    Yield match entries one Flora record at a time, for streaming responses.
+
+    Without stored results (or with `full=True`) records are scored page by page and
+    yielded as soon as their page is stored; otherwise the stored results are
+    refreshed and read back page by page. A streamed rescore holds the run's
+    lock until its last page is stored.
+    """
+    with _run_lock(session, strategy, title_threshold):
+        run = _current_run(session, strategy, title_threshold)
+        if run is None or full:
+            watermarks = _watermarks(session)
+            yield from _rescore_all(session, title_threshold, strategy, scoring, workers,
+                                    find_doi_matches(session), page_size)
+            _save_run(session, strategy, title_threshold, watermarks)
+            return
+        _refresh_run(session, run, title_threshold, strategy, scoring, False, workers)
+
+    after = None
+    while True:
+        page = load_match_results(session, title_threshold, strategy, after, page_size)
+        if not page:
+            return
+        yield from page
+        after = page[-1]['flora_publication']['id']
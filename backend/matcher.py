@@ -0,0 +1,455 @@
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from math import ceil
+
+from fuzzywuzzy import fuzz
+from sqlalchemy import func
+from metrics import MATCHER_RECORDS, MATCHER_SECONDS
+from models import Publication, FloraPublication
+from normalize import normalize_doi, normalize_title
+
+try:
+    import numpy as np
+    from rapidfuzz.distance import Indel
+    from rapidfuzz.process import cdist
+except ImportError:  # batch scoring falls back to per-pair scoring
+    np = None
+
+NGRAM_SIZE = 3
+# A candidate title must share `min_overlap` of a Flora title's n-grams to be
+# scored; 0 disables blocking (brute force). By default it is derived from the
+# title threshold, which kept full recall on the 2015 corpora (0 at 0.5 and below).
+OVERLAP_MARGIN = 0.5
+# Cells (Flora rows x candidates) per block in batch mode; a block holds a few
+# int32/bool arrays of this size, so about 20 bytes per cell (~40 MB)
+MATRIX_CELLS = 2_000_000
+
+
+def title_key(record):
+    """Normalized title used for similarity scoring, precomputed at ingest when available."""
+    if record.title_norm is not None:
+        return record.title_norm
+    return normalize_title(record.title) or ''
+
+def default_min_overlap(title_threshold):
+    return max(0.0, round(title_threshold - OVERLAP_MARGIN, 2))
+
+def title_ngrams(text, n=NGRAM_SIZE):
+    """Set of character n-grams of a title key."""
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class CandidateIndex:
+    """
+    Candidate generation index over OpenAlex/HAL publications.
+
+    Titles are split into character n-grams and stored as postings partitioned
+    by publication year, so a Flora record is only scored against publications
+    sharing at least `min_overlap` of its n-grams (or its DOI). Build it once per
+    matching run and pass it to `find_publication_matches`.
+    """
+    def __init__(self, publications, min_overlap):
+        self.min_overlap = min_overlap
+        self.publications = list(publications)
+        self.postings = defaultdict(lambda: defaultdict(list))
+        self.by_year = defaultdict(list)
+        self.position = {}
+        for pos, pub in enumerate(self.publications):
+            self.by_year[pub.year].append(pos)
+            self.position[pub.id] = pos
+            for gram in title_ngrams(title_key(pub)):
+                self.postings[pub.year][gram].append(pos)
+
+    def candidates(self, title, years=None, doi_matches=()):
+        """
+        Return the publications worth scoring against a title key.
+
+        `years` restricts the lookup to those publication years; None searches all years.
+        `doi_matches` (publications sharing the Flora DOI) are always included.
+        """
+        if years is None:
+            years = list(self.by_year)
+        years = set(years)
+
+        if self.min_overlap <= 0:
+            hits = {pos for year in years for pos in self.by_year.get(year, ())}
+        else:
+            grams = title_ngrams(title)
+            needed = max(1, ceil(self.min_overlap * len(grams)))
+            counts = Counter()
+            for year in years:
+                postings = self.postings.get(year)
+                if not postings:
+                    continue
+                for gram in grams:
+                    counts.update(postings.get(gram, ()))
+            hits = {pos for pos, count in counts.items() if count >= needed}
+
+        hits.update(self.position[pub.id] for pub in doi_matches
+                    if pub.id in self.position and pub.year in years)
+        return [self.publications[pos] for pos in sorted(hits)]
+
+
+def build_candidate_index(session, min_overlap):
+    pubs = (session.query(Publication)
+            .order_by(Publication.year, Publication.id)
+            .all())
+    return CandidateIndex(pubs, min_overlap=min_overlap)
+
+def find_doi_matches(session):
+    """
+    Map each Flora id to the OpenAlex/HAL publications sharing its DOI.
+
+    One join between `flora_publications` and `openalex_publications` on the
+    (indexed) normalized DOI replaces a DOI lookup per Flora record.
+    """
+    rows = (session.query(FloraPublication.id, Publication)
+            .join(Publication, Publication.doi_norm == FloraPublication.doi_norm)
+            .order_by(FloraPublication.id, Publication.year, Publication.id))
+    doi_matches = defaultdict(list)
+    for flora_id, pub in rows:
+        doi_matches[flora_id].append(pub)
+    return doi_matches
+
+# Find matching publications across databases
+def find_publication_matches(session, flora_pub, title_threshold=0.8, strategy='comprehensive',
+                             index=None, doi_matches=None):
+    """
+    Find OpenAlex/HAL candidates for a Flora publication.
+
+    Without `index` every publication is loaded and scored (brute force); with a
+    `CandidateIndex` only the publications it returns are scored. `doi_matches`
+    is the map from `find_doi_matches`; without it the DOI is looked up directly.
+    """
+    # Base query for OpenAlex publications
+    query = session.query(Publication)
+    matching_pubs = []
+    flora_doi = flora_pub.doi_norm or normalize_doi(flora_pub.doi)
+    if strategy == 'fuzzy':
+        same_doi = []
+    elif doi_matches is not None:
+        same_doi = doi_matches.get(flora_pub.id, [])
+    elif flora_doi:
+        same_doi = (query.filter(Publication.doi_norm == flora_doi)
+                    .order_by(Publication.year, Publication.id)
+                    .all())
+    else:
+        same_doi = []
+
+    if strategy =='exact':
+        # Exact DOI match
+        if same_doi:
+            matching_pubs.append(publication_to_dict(same_doi[0]))
+    elif strategy == 'fuzzy':
+        # Fuzzy title matching
+        if index is not None:
+            fuzzy_matches = index.candidates(title_key(flora_pub))
+        else:
+            fuzzy_matches = query.all()
+        flora_title = title_key(flora_pub)
+        for pub in fuzzy_matches:
+            title_similarity = fuzz.ratio(flora_title, title_key(pub))
+            if title_similarity >= (title_threshold * 100):
+                pub_dict = publication_to_dict(pub)
+                pub_dict['similarity'] = title_similarity
+                matching_pubs.append(pub_dict)
+    else:
+        # Combine multiple matching criteria
+        if index is not None:
+            # Year within ±1 year
+            years = [] if flora_pub.year is None else range(flora_pub.year - 1, flora_pub.year + 2)
+            comprehensive_matches = index.candidates(title_key(flora_pub), years, same_doi)
+        else:
+            comprehensive_matches = query.filter(
+                # Year within ±1 year
+                func.abs(Publication.year - flora_pub.year) <= 1
+            ).all()
+        flora_title = title_key(flora_pub)
+        same_doi_ids = {pub.id for pub in same_doi}
+        for pub in comprehensive_matches:
+            # Check title similarity
+            title_similarity = fuzz.ratio(flora_title, title_key(pub))
+            # Additional match scoring
+            match_score = 0
+            if title_similarity >= (title_threshold * 100):
+                match_score += 50
+            if pub.id in same_doi_ids:
+                match_score += 50
+
+            if match_score > 0:
+                pub_dict = publication_to_dict(pub)
+                pub_dict['similarity'] = title_similarity
+                pub_dict['match_score'] = match_score
+                matching_pubs.append(pub_dict)
+    return matching_pubs
+
+def batch_scoring_available():
+    return np is not None
+
+@contextmanager
+def scoring_pool(workers):
+    """
+    Process pool for the batch scoring of a whole matching run, or None with one worker.
+
+    Pass it to `match_flora_publications` for each batch, so the worker processes
+    are started once per run instead of once per batch.
+    """
+    if workers <= 1 or not batch_scoring_available():
+        yield None
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield pool
+
+def title_similarity_matrix(queries, choices, workers=-1):
+    """
+    `fuzz.ratio` for every (query, choice) pair of title keys, as an int matrix.
+
+    Indel distances come from one native `cdist` call and are turned into the
+    same rounded ratio fuzzywuzzy reports when backed by python-Levenshtein.
+    `workers` is the number of cdist threads (-1: all cores).
+    """
+    distances = cdist(queries, choices, scorer=Indel.distance, dtype=np.int32, workers=workers)
+    lensum = np.add.outer(np.array([len(q) for q in queries], dtype=np.int32),
+                          np.array([len(c) for c in choices], dtype=np.int32))
+    return _ratios(distances, lensum)
+
+def _ratios(distances, lensum):
+    # Two empty titles are equal, hence a ratio of 100
+    ratios = np.where(lensum > 0, (lensum - distances) / np.maximum(lensum, 1), 1.0)
+    return np.rint(100 * ratios).astype(np.int32)
+
+def _candidate_groups(flora_pubs, pubs, strategy, workers=1):
+    """
+    Yield (flora positions, publication positions) shards to score together.
+
+    Comprehensive shards are per Flora publication year (candidates within ±1 year).
+    With several workers, shards are split further so each worker gets a share.
+    """
+    if strategy == 'fuzzy':
+        groups = [(list(range(len(flora_pubs))), list(range(len(pubs))))]
+    else:
+        # Comprehensive: year within ±1 year
+        flora_by_year = defaultdict(list)
+        for i, flora_pub in enumerate(flora_pubs):
+            if flora_pub.year is not None:
+                flora_by_year[flora_pub.year].append(i)
+        pubs_by_year = defaultdict(list)
+        for j, pub in enumerate(pubs):
+            pubs_by_year[pub.year].append(j)
+        groups = []
+        for year in sorted(flora_by_year):
+            pub_positions = sorted(pubs_by_year.get(year - 1, []) + pubs_by_year.get(year, [])
+                                   + pubs_by_year.get(year + 1, []))
+            if pub_positions:
+                groups.append((flora_by_year[year], pub_positions))
+
+    shard_size = max(1, ceil(len(flora_pubs) / max(1, workers)))
+    for flora_positions, pub_positions in groups:
+        for start in range(0, len(flora_positions), shard_size):
+            yield flora_positions[start:start + shard_size], pub_positions
+
+def _score_shard(flora_keys, flora_doi_hits, pub_keys, pub_ids, title_threshold, strategy, cdist_workers=-1):
+    """
+    Score one shard of Flora titles against candidate titles.
+
+    Takes plain lists so it can run in a worker process. Returns
+    (row, col, similarity, match_score) for each match; match_score is None for fuzzy.
+
+    Flora rows are scored in blocks of at most MATRIX_CELLS cells. Pairs are first
+    kept with integer arithmetic on the Indel distances, then only those get the
+    exact `fuzz.ratio` value.
+    """
+    matches = []
+    column_of = {pub_id: col for col, pub_id in enumerate(pub_ids)}
+    pub_lengths = np.array([len(key) for key in pub_keys], dtype=np.int32)
+    block_rows = max(1, MATRIX_CELLS // max(1, len(pub_keys)))
+    min_score = title_threshold * 100
+    # The rounded ratio is at most 0.5 above 100 * (lensum - distance) / lensum
+    floor_score = ceil(min_score) - 1
+    for start in range(0, len(flora_keys), block_rows):
+        queries = flora_keys[start:start + block_rows]
+        distances = cdist(queries, pub_keys, scorer=Indel.distance, dtype=np.int32, workers=cdist_workers)
+        lensum = np.add.outer(np.array([len(q) for q in queries], dtype=np.int32), pub_lengths)
+        kept = 100 * (lensum - distances) >= floor_score * lensum
+
+        doi_ok = None
+        if strategy != 'fuzzy':
+            # Additional match scoring: DOI hits are kept whatever their title score
+            doi_ok = np.zeros(kept.shape, dtype=bool)
+            for row, hit_ids in enumerate(flora_doi_hits[start:start + block_rows]):
+                doi_ok[row, [column_of[pub_id] for pub_id in hit_ids if pub_id in column_of]] = True
+            kept |= doi_ok
+
+        rows, cols = np.nonzero(kept)
+        scores = _ratios(distances[rows, cols], lensum[rows, cols])
+        title_ok = scores >= min_score
+        if doi_ok is None:
+            matches.extend((start + row, col, score, None) for row, col, score
+                           in zip(rows[title_ok].tolist(), cols[title_ok].tolist(), scores[title_ok].tolist()))
+            continue
+
+        match_scores = 50 * title_ok.astype(np.int32) + 50 * doi_ok[rows, cols].astype(np.int32)
+        matched = match_scores > 0
+        matches.extend((start + row, col, score, match_score) for row, col, score, match_score
+                       in zip(rows[matched].tolist(), cols[matched].tolist(),
+                              scores[matched].tolist(), match_scores[matched].tolist()))
+    return matches
+
+def find_all_publication_matches(session, flora_pubs, title_threshold=0.8, strategy='comprehensive',
+                                 doi_matches=None, publications=None, workers=1, pool=None):
+    """
+    Batch version of `find_publication_matches` for a list of Flora publications.
+
+    Returns one candidate list per Flora publication, in the same order. Title keys
+    are read once and scored as Flora x candidate matrices, MATRIX_CELLS cells
+    at a time, instead of one `fuzz.ratio` call per pair. `publications` restricts
+    title scoring to those candidates (default: every publication).
+
+    With `workers` > 1 the year shards are scored in a process pool (`pool`, or
+    one started for this call); results are merged back by Flora position, so
+    the output is the same as a serial run.
+    """
+    if doi_matches is None:
+        doi_matches = find_doi_matches(session)
+    results = [[] for _ in flora_pubs]
+
+    if strategy == 'exact':
+        for i, flora_pub in enumerate(flora_pubs):
+            same_doi = doi_matches.get(flora_pub.id)
+            if same_doi:
+                results[i].append(publication_to_dict(same_doi[0]))
+        return results
+
+    if publications is None:
+        publications = (session.query(Publication)
+                        .order_by(Publication.year, Publication.id)
+                        .all())
+    pubs = list(publications)
+    flora_keys = [title_key(flora_pub) for flora_pub in flora_pubs]
+    pub_keys = [title_key(pub) for pub in pubs]
+
+    shards = list(_candidate_groups(flora_pubs, pubs, strategy, workers))
+    shard_args = [
+        ([flora_keys[i] for i in flora_positions],
+         [[pub.id for pub in doi_matches.get(flora_pubs[i].id, ())] for i in flora_positions],
+         [pub_keys[j] for j in pub_positions],
+         [pubs[j].id for j in pub_positions],
+         title_threshold,
+         strategy)
+        for flora_positions, pub_positions in shards
+    ]
+    if workers > 1 and len(shards) > 1:
+        # One cdist thread per process, the pool already uses every core
+        if pool is not None:
+            shard_matches = list(pool.map(_score_shard, *zip(*shard_args), [1] * len(shard_args)))
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers, len(shards))) as pool:
+                shard_matches = list(pool.map(_score_shard, *zip(*shard_args), [1] * len(shard_args)))
+    else:
+        shard_matches = [_score_shard(*args) for args in shard_args]
+
+    for (flora_positions, pub_positions), matches in zip(shards, shard_matches):
+        for row, col, similarity, match_score in matches:
+            pub_dict = publication_to_dict(pubs[pub_positions[col]])
+            pub_dict['similarity'] = similarity
+            if match_score is not None:
+                pub_dict['match_score'] = match_score
+            results[flora_positions[row]].append(pub_dict)
+    return results
+
+def match_flora_publications(session, flora_pubs, title_threshold=0.8, strategy='comprehensive',
+                             scoring='batch', min_overlap=None, doi_matches=None, publications=None,
+                             workers=1, pool=None):
+    """
+    Candidate lists for `flora_pubs`, scored in batch when available, else pair by pair.
+
+    `workers` > 1 scores the batch shards in that many processes, in `pool` when
+    given (see `scoring_pool`). `scoring='lsh'`
+    scores pair by pair, taking candidates from the MinHash/LSH title index.
+    """
+    if doi_matches is None:
+        # Flora id -> publications with the same DOI, from a single join
+        doi_matches = find_doi_matches(session)
+
+    # Labelled with the scoring actually used ('batch' falls back to pair scoring)
+    used = 'pair' if scoring == 'batch' and not batch_scoring_available() else scoring
+    MATCHER_RECORDS.inc(len(flora_pubs), strategy=strategy, scoring=used)
+    with MATCHER_SECONDS.time(strategy=strategy, scoring=used):
+        if scoring == 'batch' and batch_scoring_available():
+            # Score the whole Flora x candidate matrix in native code
+            return find_all_publication_matches(session, flora_pubs, title_threshold, strategy,
+                                                doi_matches=doi_matches, publications=publications,
+                                                workers=workers, pool=pool)
+
+        # Build the candidate index once for the whole run
+        index = None
+        if strategy != 'exact' and scoring == 'lsh':
+            from lsh_index import LSHCandidateIndex, build_title_lsh, load_title_lsh
+            lsh = load_title_lsh() or build_title_lsh(session)
+            if publications is None:
+                publications = (session.query(Publication)
+                                .order_by(Publication.year, Publication.id)
+                                .all())
+            index = LSHCandidateIndex(lsh, publications)
+        elif strategy != 'exact':
+            if min_overlap is None:
+                min_overlap = default_min_overlap(title_threshold)
+            if publications is None:
+                index = build_candidate_index(session, min_overlap)
+            else:
+                index = CandidateIndex(publications, min_overlap)
+        return [
+            find_publication_matches(session, flora_pub, title_threshold, strategy,
+                                     index=index, doi_matches=doi_matches)
+            for flora_pub in flora_pubs
+        ]
+
+def measure_recall(session, flora_pubs, title_threshold=0.8, strategy='comprehensive', min_overlap=None,
+                   lsh=None):
+    """
+    Compare indexed matching against brute force for the given Flora publications.
+
+    Returns the fraction of brute-force (flora id, candidate id) pairs that the
+    index also finds, so `min_overlap` (or the `lsh` band/row setup, when given
+    a `TitleLSH`) can be tuned for the data at hand.
+    """
+    if lsh is not None:
+        from lsh_index import LSHCandidateIndex
+        pubs = (session.query(Publication)
+                .order_by(Publication.year, Publication.id)
+                .all())
+        index = LSHCandidateIndex(lsh, pubs)
+    else:
+        if min_overlap is None:
+            min_overlap = default_min_overlap(title_threshold)
+        index = build_candidate_index(session, min_overlap)
+    doi_matches = find_doi_matches(session)
+    expected, found = set(), set()
+    for flora_pub in flora_pubs:
+        for pub in find_publication_matches(session, flora_pub, title_threshold, strategy):
+            expected.add((flora_pub.id, pub['id']))
+        for pub in find_publication_matches(session, flora_pub, title_threshold, strategy,
+                                            index=index, doi_matches=doi_matches):
+            found.add((flora_pub.id, pub['id']))
+    recall = len(expected & found) / len(expected) if expected else 1.0
+    return {
+        'expected': len(expected),
+        'found': len(found),
+        'missed': len(expected - found),
+        'recall': recall
+    }
+
+def publication_to_dict(pub):
+    return {
+        'id': pub.id,
+        'title': pub.title,
+        'doi': pub.doi,
+        'type': pub.type,
+        'source': pub.source,
+        'year': pub.year,
+        'isValid': pub.isValid,
+        'comment': pub.comment
+    }
@@ -0,0 +1,134 @@
+"""
+In-process metrics rendered in the Prometheus text exposition format.
+
+Values are kept per process; with several workers, scrape each one (or sum them).
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+# Seconds; covers fast API reads up to multi-minute crawls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+_registry = []
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            # [per-bucket counts, sum, count]
+            state = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (bucket_counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                labels = _format_labels(self.labelnames, key, [('le', '+Inf')])
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+def render():
+    """Every registered metric, in Prometheus text format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', "Flask request latency until the response is returned",
+                            ['route', 'method', 'status'])
+FETCHER_REQUESTS = Counter('fetcher_http_requests_total', "HTTP calls made by the fetchers",
+                           ['fetcher', 'status'])
+FETCHER_BYTES = Counter('fetcher_http_response_bytes_total', "Response bytes received by the fetchers",
+                        ['fetcher'])
+FETCHER_SECONDS = Histogram('fetcher_http_request_duration_seconds', "Fetcher HTTP call latency",
+                            ['fetcher'])
+DB_QUERY_SECONDS = Histogram('db_query_duration_seconds', "Database statement execution time",
+                             ['operation'], buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30))
+DB_ROWS_INSERTED = Counter('db_rows_inserted_total', "Records inserted by ingestion", ['table'])
+DB_ROWS_UPDATED = Counter('db_rows_updated_total', "Stored records updated because their content changed upstream",
+                          ['table'])
+DB_ROWS_UNCHANGED = Counter('db_rows_unchanged_total', "Fetched records already stored with the same content",
+                            ['table'])
+MATCHER_SECONDS = Histogram('matcher_scoring_duration_seconds', "Time spent scoring Flora records",
+                            ['strategy', 'scoring'])
+MATCHER_RECORDS = Counter('matcher_flora_records_scored_total', "Flora records scored by the matcher",
+                          ['strategy', 'scoring'])
+
+
+def instrument_engine(engine):
+    """Time every statement run through `engine`, labelled by its SQL verb."""
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _start(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _stop(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info['query_start'].pop()
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+        DB_QUERY_SECONDS.observe(time.perf_counter() - start, operation=operation)
@@ -1,11 +1,17 @@
 from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy import Column, String, Integer, Boolean, Text
+from datetime import datetime, timezone
+from sqlalchemy import Column, String, Integer, Boolean, Text, DateTime, Float
 
 Base = declarative_base()
 
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 class Publication(Base):
     __tablename__ = 'openalex_publications'
     __table_args__ = {'extend_existing': True}
+    # Fields set by the fetchers, covered by `content_hash`
+    CONTENT_FIELDS = ('doi', 'title', 'type', 'source', 'year')
     
     id = Column(String, primary_key=True)
     # source = Column(String)
@@ -17,16 +23,69 @@ class Publication(Base):
     # Optional validation fields:
     isValid = Column(Boolean, default=False)
     comment = Column(Text, nullable=True)
+    # Normalized title/DOI used for matching, filled at ingest (see normalize.py)
+    title_norm = Column(String)
+    doi_norm = Column(String, index=True)
+    # Hash of the CONTENT_FIELDS as last fetched, to detect upstream corrections
+    content_hash = Column(String(40))
+    # Set when the record is inserted or changed by ingestion (not by validation)
+    updated_at = Column(DateTime, default=utcnow, index=True)
 
 class FloraPublication(Base):
     __tablename__ = 'flora_publications'
     __table_args__ = {'extend_existing': True}
+    CONTENT_FIELDS = ('doi', 'title', 'source', 'year')
     
     id = Column(String, primary_key=True)
     doi = Column(String)
     title = Column(String)
     source = Column(String)
     year = Column(Integer)
+    title_norm = Column(String)
+    doi_norm = Column(String, index=True)
+    content_hash = Column(String(40))
+    updated_at = Column(DateTime, default=utcnow, index=True)
     # # Optional validation fields:
     # isValid = Column(Boolean, default=False)
     # comment = Column(Text, nullable=True)
+
+class MatchResult(Base):
+    """Stored match candidate of a Flora publication for one strategy/threshold."""
+    __tablename__ = 'match_results'
+    __table_args__ = {'extend_existing': True}
+
+    strategy = Column(String, primary_key=True)
+    title_threshold = Column(Float, primary_key=True)
+    flora_id = Column(String, primary_key=True)
+    candidate_id = Column(String, primary_key=True, index=True)
+    similarity = Column(Integer, nullable=True)
+    match_score = Column(Integer, nullable=True)
+
+class MatchRun(Base):
+    """Ingestion watermarks up to which `match_results` are up to date."""
+    __tablename__ = 'match_runs'
+    __table_args__ = {'extend_existing': True}
+
+    strategy = Column(String, primary_key=True)
+    title_threshold = Column(Float, primary_key=True)
+    flora_watermark = Column(DateTime, nullable=True)
+    publication_watermark = Column(DateTime, nullable=True)
+    computed_at = Column(DateTime, nullable=True)
+
+class TableVersion(Base):
+    """Version token of a table, bumped whenever its rows are inserted or updated."""
+    __tablename__ = 'table_versions'
+    __table_args__ = {'extend_existing': True}
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+class SyncState(Base):
+    """Watermark of the last complete sync of a fetcher, per query (see sync_state.py)."""
+    __tablename__ = 'sync_states'
+    __table_args__ = {'extend_existing': True}
+
+    source = Column(String, primary_key=True)
+    query_key = Column(String, primary_key=True)
+    watermark = Column(Text, nullable=True)
+    synced_at = Column(DateTime, nullable=True)
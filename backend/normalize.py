@@ -0,0 +1,51 @@
+import hashlib
+import json
+import re
+import unicodedata
+
+DOI_PREFIXES = ['https://doi.org/', 'http://doi.org/', 'https://dx.doi.org/', 'http://dx.doi.org/',
+                'dx.doi.org/', 'doi.org/', 'doi:']
+
+_MARKUP = re.compile(r'<[^>]+>')
+_NON_ALNUM = re.compile(r'[\W_]+')
+
+
+def normalize_title(title):
+    """
+    Comparable form of a title: markup removed, Unicode-folded (accents stripped),
+    punctuation replaced by spaces, lowercased and whitespace-collapsed.
+    """
+    if title is None:
+        return None
+    text = _MARKUP.sub(' ', title)
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    text = _NON_ALNUM.sub(' ', text.casefold())
+    return ' '.join(text.split())
+
+def normalize_doi(doi):
+    """Bare lowercase DOI (no resolver prefix), or None when there is none."""
+    if doi is None:
+        return None
+    doi = doi.strip().lower()
+    for prefix in DOI_PREFIXES:
+        if doi.startswith(prefix):
+            doi = doi[len(prefix):]
+            break
+    return doi.strip() or None
+
+def add_normalized_fields(record):
+    """Fill `title_norm`/`doi_norm` of a normalized fetcher record (in place)."""
+    record['title_norm'] = normalize_title(record.get('title'))
+    record['doi_norm'] = normalize_doi(record.get('doi'))
+    return record
+
+def content_hash(record, fields):
+    """
+    SHA-1 of the `fields` of a record, used to detect records changed upstream.
+
+    Values are hashed as text, so a fetched dict (e.g. year "2015") and the
+    stored row (year 2015) with the same content hash alike.
+    """
+    values = [None if record.get(field) is None else str(record.get(field)) for field in fields]
+    return hashlib.sha1(json.dumps(values, ensure_ascii=False).encode('utf-8')).hexdigest()
@@ -0,0 +1,129 @@
+"""
+Opt-in cProfile captures of single requests, fetch jobs and fetch_data.py runs.
+
+Nothing is profiled unless asked for:
+- any route: `?profile=1` or an `X-Profile: 1` header saves the profile to
+  Config.PROFILE_DIR (named in the `X-Profile-File` response header), and
+  `profile=response` returns the hot functions instead of the normal body;
+- `/fetch_data?profile=1`: the background job is profiled (see the job's `profile`);
+- `python fetch_data.py --profile`.
+
+Each capture is saved as `<name>.prof` (open with pstats or snakeviz) and
+`<name>.txt`, the top functions by cumulative time. cProfile only sees the
+thread that started it: worker threads (e.g. the fetchers of a sync) wrap their
+work in `profiled_thread` and are merged into the capture.
+"""
+import cProfile
+import io
+import os
+import pstats
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from config import Config
+
+# Functions listed in the text summary
+TOP_FUNCTIONS = 30
+
+# Capture started by the current thread, if any
+_local = threading.local()
+
+
+def profile_requested(value):
+    """Whether a query/header flag value asks for a profile."""
+    return value is not None and value.strip().lower() not in ('', '0', 'false', 'no', 'off')
+
+
+class Profile:
+    """One cProfile capture; `path` and `summary` are set once it is stopped."""
+    def __init__(self, name):
+        self.name = name
+        self.active = False
+        self.path = None
+        self.summary = None
+        self._profiler = cProfile.Profile()
+        # Profilers of worker threads, merged in when stopped
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        try:
+            self._profiler.enable()
+            self.active = True
+            _local.profile = self
+        except ValueError as e:
+            # Python 3.12+ allows one cProfile at a time per process
+            print(f"Profiling of {self.name} skipped: {e}")
+        return self
+
+    def add_thread(self, profiler):
+        """Merge a worker thread's stopped profiler into this capture, if still running."""
+        with self._lock:
+            if self.active:
+                self._threads.append(profiler)
+
+    def stop(self, save=True):
+        """Stop profiling, build the summary and (if `save`) write both files."""
+        if not self.active:
+            return None
+        self._profiler.disable()
+        with self._lock:
+            self.active = False
+        if getattr(_local, 'profile', None) is self:
+            _local.profile = None
+        stream = io.StringIO()
+        stats = pstats.Stats(self._profiler, stream=stream)
+        for profiler in self._threads:
+            stats.add(profiler)
+        stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+        self.summary = stream.getvalue()
+        if save:
+            slug = re.sub(r'[^A-Za-z0-9_.-]+', '_', self.name).strip('_')
+            base = os.path.join(Config.PROFILE_DIR,
+                                f"{time.strftime('%Y%m%d-%H%M%S')}-{slug}-{uuid.uuid4().hex[:6]}")
+            os.makedirs(Config.PROFILE_DIR, exist_ok=True)
+            stats.dump_stats(base + '.prof')
+            with open(base + '.txt', 'w', encoding='utf-8') as f:
+                f.write(self.summary)
+            self.path = base + '.prof'
+        return self.path
+
+
+def current_profile():
+    """The running capture started by this thread, to hand over to worker threads."""
+    profile = getattr(_local, 'profile', None)
+    return profile if profile is not None and profile.active else None
+
+@contextmanager
+def profiled_thread(profile):
+    """Profile the block in this worker thread and merge it into `profile` (None: no-op)."""
+    if profile is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Python 3.12+: the running capture already covers every thread
+        yield
+        return
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profile.add_thread(profiler)
+
+@contextmanager
+def profiled(name, enabled=True):
+    """Profile the block and save it when `enabled`; yields the Profile, or None when disabled."""
+    if not enabled:
+        yield None
+        return
+    profile = Profile(name).start()
+    try:
+        yield profile
+    finally:
+        profile.stop()
@@ -0,0 +1,112 @@
+from sqlalchemy import and_, or_, select
+from models import Publication, FloraPublication
+
+# Columns `fields=` may select, in response order; the defaults keep the original payloads
+PUBLICATION_FIELDS = {
+    Publication: ['id', 'title', 'doi', 'type', 'source', 'year', 'isValid', 'comment'],
+    FloraPublication: ['id', 'title', 'doi', 'source', 'year']
+}
+# Rows per page when `limit` is larger
+MAX_PAGE_SIZE = 1000
+
+
+def parse_fields(model_class, fields):
+    """Requested columns of a comma-separated `fields` value (all columns when empty)."""
+    allowed = PUBLICATION_FIELDS[model_class]
+    if not fields:
+        return allowed
+    requested = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in requested if field not in allowed]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)} (allowed: {', '.join(allowed)})")
+    return [field for field in allowed if field in requested]
+
+def parse_limit(limit):
+    """A `limit` query value: None when absent, else a positive page size."""
+    if limit is not None and limit < 1:
+        raise ValueError(f"Invalid limit: {limit} (must be at least 1)")
+    return limit
+
+def encode_cursor(year, pub_id):
+    return f"{'' if year is None else year}:{pub_id}"
+
+def decode_cursor(cursor):
+    """(year, id) of a cursor made by `encode_cursor`; the year is None for rows without one."""
+    year, sep, pub_id = cursor.partition(':')
+    if not sep or not pub_id:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return (int(year) if year else None), pub_id
+
+def _after(model_class, cursor):
+    # Rows after (year, id) in "year, id" order, rows without a year coming last
+    year, pub_id = decode_cursor(cursor)
+    if year is None:
+        return and_(model_class.year.is_(None), model_class.id > pub_id)
+    return or_(model_class.year > year,
+               and_(model_class.year == year, model_class.id > pub_id),
+               model_class.year.is_(None))
+
+def publication_filters(model_class, year=None, type=None, source=None, is_valid=None):
+    """
+    Filter clauses for the `/api/publications` query parameters.
+
+    `source` matches part of the journal/source name, case-insensitively. `type`
+    and `is_valid` only exist on OpenAlex/HAL publications.
+    """
+    clauses = []
+    if year is not None:
+        clauses.append(model_class.year == year)
+    if source:
+        clauses.append(model_class.source.ilike(f"%{source}%"))
+    if model_class is Publication:
+        if type:
+            clauses.append(Publication.type == type)
+        if is_valid is not None:
+            # Rows never validated have isValid NULL when inserted outside the ORM
+            clauses.append(Publication.isValid.is_(True) if is_valid
+                           else or_(Publication.isValid.is_(False), Publication.isValid.is_(None)))
+    return clauses
+
+def _select_publications(model_class, fields, filters=(), after=None):
+    # year/id are always read, they make up the cursor
+    columns = [getattr(model_class, field) for field in fields]
+    stmt = (select(*columns, model_class.year.label('_year'), model_class.id.label('_id'))
+            .where(*filters)
+            .order_by(model_class.year.asc().nulls_last(), model_class.id))
+    if after:
+        stmt = stmt.where(_after(model_class, after))
+    return stmt
+
+def query_publications(session, model_class, fields=None, filters=(), after=None, limit=None):
+    """
+    Rows of `model_class` as dicts of `fields`, ordered by (year, id).
+
+    Only the selected columns are read (Core select, no ORM objects). With `limit`,
+    returns one page and the cursor of the next one (None on the last page); pass
+    it back as `after` to continue.
+    """
+    fields = fields or PUBLICATION_FIELDS[model_class]
+    limit = parse_limit(limit)
+    stmt = _select_publications(model_class, fields, filters, after)
+    if limit:
+        stmt = stmt.limit(min(limit, MAX_PAGE_SIZE))
+
+    rows = session.execute(stmt).all()
+    publications = [dict(zip(fields, row)) for row in rows]
+    next_cursor = None
+    if limit and len(rows) == min(limit, MAX_PAGE_SIZE):
+        next_cursor = encode_cursor(rows[-1]._year, rows[-1]._id)
+    return publications, next_cursor
+
+def iter_publications(session, model_class, fields=None, filters=(), after=None, batch_size=1000):
+    """
+    Every matching row as a dict of `fields`, in (year, id) order, read `batch_size` rows at a time.
+
+    Rows are fetched from a server-side cursor where the driver supports it, so
+    memory does not grow with the table.
+    """
+    fields = fields or PUBLICATION_FIELDS[model_class]
+    result = session.execute(_select_publications(model_class, fields, filters, after),
+                             execution_options={'yield_per': batch_size})
+    for row in result:
+        yield dict(zip(fields, row))
@@ -0,0 +1,193 @@
+import csv
+import glob
+import os
+from collections import namedtuple
+
+from fuzzywuzzy import fuzz
+from config import Config
+from models import Publication, FloraPublication
+from matcher import CandidateIndex, default_min_overlap, title_key
+from normalize import normalize_doi, normalize_title
+
+SOURCES = ('flora', 'openalex', 'hal', 'wos')
+
+# One record of any source, shaped like the ORM rows `CandidateIndex` indexes
+SourceRecord = namedtuple('SourceRecord', ['source', 'id', 'doi', 'title', 'year', 'title_norm', 'doi_norm'])
+
+
+class UnionFind:
+    """Disjoint sets over 0..n-1 with path halving and union by size."""
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.size = [1] * n
+
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i, j):
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i == root_j:
+            return False
+        if self.size[root_i] < self.size[root_j]:
+            root_i, root_j = root_j, root_i
+        self.parent[root_j] = root_i
+        self.size[root_i] += self.size[root_j]
+        return True
+
+
+def publication_source(pub):
+    """'openalex' or 'hal' for a row of `openalex_publications` (both share the table)."""
+    return 'openalex' if pub.id.startswith('openalex.org/') else 'hal'
+
+def _parse_year(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+def load_wos_records(path):
+    """Records of a WoS CSV written by `wos_scraper.analyze_excel_file`."""
+    records = []
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            title = row.get('title') or None
+            doi = row.get('doi') or None
+            records.append(SourceRecord('wos', row['id'], doi, title, _parse_year(row.get('year')),
+                                        normalize_title(title), normalize_doi(doi)))
+    return records
+
+def load_source_records(session, wos_paths=None):
+    """
+    Flora, OpenAlex and HAL rows plus the WoS CSV records, one entry per (source, id).
+
+    `wos_paths` defaults to every `WoS_*.csv` in `Config.WOS_DATA_DIR`.
+    """
+    records = []
+    for flora_pub in session.query(FloraPublication).order_by(FloraPublication.id):
+        records.append(SourceRecord('flora', flora_pub.id, flora_pub.doi, flora_pub.title, flora_pub.year,
+                                    title_key(flora_pub), flora_pub.doi_norm or normalize_doi(flora_pub.doi)))
+    for pub in session.query(Publication).order_by(Publication.id):
+        records.append(SourceRecord(publication_source(pub), pub.id, pub.doi, pub.title, pub.year,
+                                    title_key(pub), pub.doi_norm or normalize_doi(pub.doi)))
+    if wos_paths is None:
+        wos_paths = sorted(glob.glob(os.path.join(Config.WOS_DATA_DIR, 'WoS_*.csv')))
+    for path in wos_paths:
+        records.extend(load_wos_records(path))
+
+    seen = set()
+    unique = []
+    for record in records:
+        if (record.source, record.id) not in seen:
+            seen.add((record.source, record.id))
+            unique.append(record)
+    return unique
+
+def resolve_entities(records, title_threshold=0.9, min_overlap=None):
+    """
+    Group records of all sources into clusters, one per paper.
+
+    Records sharing a normalized DOI are merged, as are records of different
+    sources whose normalized titles reach `title_threshold` (`fuzz.ratio`, years
+    within ±1) unless both carry different DOIs. Merging is transitive (union-find).
+    Candidate pairs come from the title n-gram `CandidateIndex`, so records are
+    not compared all against all. Returns a list of clusters with `cluster_id`
+    numbered in record order.
+    """
+    records = list(records)
+    clusters = UnionFind(len(records))
+
+    # DOI equality
+    first_with_doi = {}
+    for i, record in enumerate(records):
+        if record.doi_norm:
+            clusters.union(first_with_doi.setdefault(record.doi_norm, i), i)
+
+    # Title similarity across sources
+    if min_overlap is None:
+        min_overlap = default_min_overlap(title_threshold)
+    index = CandidateIndex(records, min_overlap)
+    position = {(record.source, record.id): i for i, record in enumerate(records)}
+    for i, record in enumerate(records):
+        if not record.title_norm:
+            continue
+        years = None if record.year is None else (record.year - 1, record.year, record.year + 1)
+        for candidate in index.candidates(record.title_norm, years):
+            j = position[(candidate.source, candidate.id)]
+            if j <= i or candidate.source == record.source:
+                continue
+            if record.doi_norm and candidate.doi_norm and record.doi_norm != candidate.doi_norm:
+                continue
+            if clusters.find(i) == clusters.find(j):
+                continue
+            if fuzz.ratio(record.title_norm, candidate.title_norm) >= title_threshold * 100:
+                clusters.union(i, j)
+
+    cluster_of_root = {}
+    result = []
+    for i, record in enumerate(records):
+        root = clusters.find(i)
+        if root not in cluster_of_root:
+            cluster_of_root[root] = len(result)
+            result.append({'cluster_id': len(result), 'sources': [], 'records': []})
+        cluster = result[cluster_of_root[root]]
+        if record.source not in cluster['sources']:
+            cluster['sources'].append(record.source)
+        cluster['records'].append({
+            'source': record.source,
+            'id': record.id,
+            'title': record.title,
+            'doi': record.doi,
+            'year': record.year
+        })
+    for cluster in result:
+        cluster['sources'].sort(key=SOURCES.index)
+    return result
+
+def flora_coverage(clusters, sources=('openalex', 'hal', 'wos')):
+    """
+    Each Flora record with its cluster id and the `sources` its cluster lacks.
+
+    Only Flora records missing at least one of `sources` are listed, e.g.
+    `sources=('wos', 'openalex')` lists Flora entries absent from WoS or OpenAlex.
+    """
+    coverage = []
+    for cluster in clusters:
+        missing = [source for source in sources if source not in cluster['sources']]
+        if not missing:
+            continue
+        for record in cluster['records']:
+            if record['source'] == 'flora':
+                coverage.append({'cluster_id': cluster['cluster_id'], 'flora_publication': record,
+                                 'missing': missing})
+    return coverage
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from collections import Counter
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Cluster Flora, OpenAlex, HAL and WoS records into papers.")
+    parser.add_argument('--title-threshold', type=float, default=0.9)
+    parser.add_argument('--wos', nargs='*', help="WoS CSV files (default: WoS_*.csv in Config.WOS_DATA_DIR)")
+    parser.add_argument('--missing', default='openalex,hal,wos',
+                        help="comma-separated sources to report missing Flora entries for")
+    args = parser.parse_args()
+
+    session = SessionLocal()
+    try:
+        records = load_source_records(session, args.wos)
+        clusters = resolve_entities(records, args.title_threshold)
+        coverage = flora_coverage(clusters, args.missing.split(','))
+        print(json.dumps({
+            'records': len(records),
+            'clusters': len(clusters),
+            'source_combinations': Counter('+'.join(c['sources']) for c in clusters).most_common(),
+            'flora_missing': len(coverage)
+        }, indent=2))
+    finally:
+        session.close()
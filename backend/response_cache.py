@@ -0,0 +1,69 @@
+import threading
+from collections import OrderedDict
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import TableVersion
+
+# Dialects with INSERT ... ON CONFLICT, for an atomic first bump
+UPSERT_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+def bump_table_version(session, *tables):
+    """
+    Increment the version of each table name, in the caller's transaction.
+
+    Call it wherever rows of those tables are inserted or updated, so cached
+    responses built from them are invalidated once the transaction commits.
+    """
+    insert = UPSERT_INSERTS.get(session.get_bind().dialect.name)
+    for table in tables:
+        if insert is not None:
+            # One statement, so two first bumps of a table cannot both INSERT
+            statement = insert(TableVersion).values(name=table, version=1)
+            session.execute(statement.on_conflict_do_update(
+                index_elements=[TableVersion.name],
+                set_={'version': TableVersion.version + 1}))
+            continue
+        bumped = (session.query(TableVersion)
+                  .filter(TableVersion.name == table)
+                  .update({TableVersion.version: TableVersion.version + 1}, synchronize_session=False))
+        if not bumped:
+            session.add(TableVersion(name=table, version=1))
+
+def get_table_versions(session, tables):
+    """Current versions of `tables`, in order (0 for a table never bumped)."""
+    rows = dict(session.query(TableVersion.name, TableVersion.version)
+                .filter(TableVersion.name.in_(tables)))
+    return tuple(rows.get(table, 0) for table in tables)
+
+
+class LRUCache:
+    """Thread-safe mapping that keeps the `maxsize` most recently used entries."""
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,130 @@
+import re
+
+from sqlalchemy import column, func, literal_column, table, text
+from database import engine
+from models import Publication, FloraPublication
+from publication_query import PUBLICATION_FIELDS
+
+SEARCH_MODELS = {
+    'openalex': [Publication],
+    'flora': [FloraPublication],
+    'all': [Publication, FloraPublication]
+}
+MAX_RESULTS = 100
+_WORD = re.compile(r'\w+')
+
+
+def _tsvector(model_class):
+    # Same expression as the GIN index, so PostgreSQL can use it
+    return func.to_tsvector(literal_column("'simple'"), func.coalesce(model_class.title, literal_column("''")))
+
+def _fts_table(model_class):
+    return f"{model_class.__tablename__}_fts"
+
+def create_search_indexes():
+    """
+    Create the title full-text indexes if they are missing.
+
+    PostgreSQL: a GIN index on the 'simple' tsvector of the title. SQLite: an FTS5
+    table over the title, kept in sync by triggers and filled once on creation.
+    Other databases fall back to LIKE searches without an index.
+    """
+    with engine.begin() as conn:
+        for model_class in (Publication, FloraPublication):
+            table = model_class.__tablename__
+            if engine.dialect.name == 'postgresql':
+                conn.execute(text(
+                    f"CREATE INDEX IF NOT EXISTS ix_{table}_title_fts ON {table} "
+                    f"USING GIN (to_tsvector('simple', coalesce(title, '')))"
+                ))
+            elif engine.dialect.name == 'sqlite':
+                fts = _fts_table(model_class)
+                exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = :name"),
+                                      {'name': fts}).first()
+                if exists:
+                    continue
+                conn.execute(text(
+                    f"CREATE VIRTUAL TABLE {fts} USING fts5(title, content='{table}', "
+                    f"content_rowid='rowid', tokenize='unicode61 remove_diacritics 2')"
+                ))
+                conn.execute(text(
+                    f"CREATE TRIGGER {fts}_ai AFTER INSERT ON {table} BEGIN "
+                    f"INSERT INTO {fts}(rowid, title) VALUES (new.rowid, new.title); END"
+                ))
+                conn.execute(text(
+                    f"CREATE TRIGGER {fts}_ad AFTER DELETE ON {table} BEGIN "
+                    f"INSERT INTO {fts}({fts}, rowid, title) VALUES ('delete', old.rowid, old.title); END"
+                ))
+                conn.execute(text(
+                    f"CREATE TRIGGER {fts}_au AFTER UPDATE OF title ON {table} BEGIN "
+                    f"INSERT INTO {fts}({fts}, rowid, title) VALUES ('delete', old.rowid, old.title); "
+                    f"INSERT INTO {fts}(rowid, title) VALUES (new.rowid, new.title); END"
+                ))
+                conn.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+
+def _fts5_query(terms):
+    # Every word must appear, the last one as a prefix (search-as-you-type)
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+def _tsquery(terms):
+    # Same rule for PostgreSQL: 'word' & ... & 'last':*
+    quoted = [f"'{term}'" for term in terms]
+    quoted[-1] += ':*'
+    return ' & '.join(quoted)
+
+def _search_model(session, model_class, terms, limit):
+    """Best `limit` matches of one table as (rank, publication dict), higher rank first."""
+    fields = PUBLICATION_FIELDS[model_class]
+    columns = [getattr(model_class, field) for field in fields]
+
+    if engine.dialect.name == 'postgresql':
+        tsquery = func.to_tsquery(literal_column("'simple'"), _tsquery(terms))
+        rank = func.ts_rank(_tsvector(model_class), tsquery)
+        query = (session.query(*columns, rank.label('rank'))
+                 .filter(_tsvector(model_class).op('@@')(tsquery))
+                 .order_by(rank.desc(), model_class.year, model_class.id))
+    elif engine.dialect.name == 'sqlite':
+        fts = _fts_table(model_class)
+        fts_table = table(fts, column('rowid'))
+        # bm25() is lower for better matches
+        rank = literal_column(f"-bm25({fts})")
+        query = (session.query(*columns, rank.label('rank'))
+                 .select_from(model_class)
+                 .join(fts_table, fts_table.c.rowid == literal_column(f"{model_class.__tablename__}.rowid"))
+                 .filter(text(f"{fts} MATCH :match").bindparams(match=_fts5_query(terms)))
+                 .order_by(rank.desc(), model_class.year, model_class.id))
+    else:
+        rank = literal_column('0')
+        query = (session.query(*columns, rank.label('rank'))
+                 .filter(*[model_class.title.ilike(f"%{term}%") for term in terms])
+                 .order_by(model_class.year, model_class.id))
+
+    results = []
+    for row in query.limit(limit):
+        publication = dict(zip(fields, row))
+        publication['table'] = 'flora' if model_class is FloraPublication else 'openalex'
+        publication['rank'] = round(float(row.rank), 4)
+        results.append((publication['rank'], publication))
+    return results
+
+def search_publications(session, q, source='openalex', limit=20, offset=0):
+    """
+    Publications whose title contains every word of `q`, best ranked first.
+
+    `source` is 'openalex', 'flora' or 'all' (both tables, merged by rank).
+    Returns one page of results and the offset of the next page (None on the last one).
+    """
+    terms = _WORD.findall(q or '')
+    if not terms:
+        return [], None
+    limit = max(1, min(limit, MAX_RESULTS))
+    ranked = []
+    for model_class in SEARCH_MODELS[source]:
+        # One extra row tells whether there is a next page
+        ranked.extend(_search_model(session, model_class, terms, offset + limit + 1))
+    ranked.sort(key=lambda item: -item[0])
+    page = [publication for _, publication in ranked[offset:offset + limit]]
+    next_offset = offset + limit if len(ranked) > offset + limit else None
+    return page, next_offset
@@ -8,6 +8,26 @@ function FetchData() {
 
   // Define the API base URL
   const API_BASE_URL = 'http://127.0.0.1:5000'; // Change this to match your backend URL
+  const POLL_INTERVAL_MS = 2000;
+
+  // The fetch runs as a background job: poll its status until it is finished
+  const waitForJob = async (statusUrl) => {
+    while (true) {
+      const response = await fetch(`${API_BASE_URL}${statusUrl}`);
+      const job = await response.json();
+      if (!response.ok) {
+        throw new Error(job.error || 'Failed to read the fetch job status');
+      }
+      setApiResponse(job);
+      if (job.status === 'done') {
+        return job;
+      }
+      if (job.status === 'failed') {
+        throw new Error(job.error || 'The data fetch failed');
+      }
+      await new Promise(resolve => setTimeout(resolve, POLL_INTERVAL_MS));
+    }
+  };
 
   const handleFetchData = async (dataType) => {
     setIsLoading(true);
@@ -41,6 +61,8 @@ function FetchData() {
       }
       
       setApiResponse(data);
+      const job = await waitForJob(data.status_url);
+      setApiResponse({ ...job, message: 'Data fetched successfully' });
     } catch (error) {
       console.error('Error fetching data:', error);
       setErrorMessage(error.message || 'Failed to fetch data. Please try again.');
@@ -84,7 +106,12 @@ function FetchData() {
 
   const renderResponse = () => {
     if (isLoading) {
-      return <div className="loading">Fetching data... This may take a while.</div>;
+      return (
+        <div className="loading">
+          Fetching data... This may take a while.
+          {apiResponse && apiResponse.phase && <div>{apiResponse.phase} ({apiResponse.elapsed}s)</div>}
+        </div>
+      );
     }
 
     if (errorMessage) {
@@ -9,24 +9,54 @@ const PublicationMatcher = () => {
   const [isLoading, setIsLoading] = useState(false);
 
   useEffect(() => {
+    const controller = new AbortController();
+
+    // Matches are streamed as NDJSON (one Flora record per line) and shown as they arrive
     const fetchMatches = async () => {
       setIsLoading(true);
+      setPublicationMatches([]);
       try {
-        const response = await axios.get('http://localhost:5000/api/publications/match', {
-          params: {
-            strategy: matchingStrategy,
-            title_threshold: similarityThreshold
-          }
+        const params = new URLSearchParams({
+          strategy: matchingStrategy,
+          title_threshold: similarityThreshold,
+          format: 'ndjson'
+        });
+        const response = await fetch(`http://localhost:5000/api/publications/match?${params}`, {
+          signal: controller.signal
         });
-        setPublicationMatches(response.data);
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+          const { done, value } = await reader.read();
+          if (done) break;
+          buffer += decoder.decode(value, { stream: true });
+          const lines = buffer.split('\n');
+          buffer = lines.pop();
+          const received = lines.filter(line => line.trim()).map(line => JSON.parse(line));
+          const errors = received.filter(match => match.error);
+          if (errors.length > 0) {
+            console.error('Matching failed:', errors[0].error);
+          }
+          const batch = received.filter(match => !match.error);
+          if (batch.length > 0) {
+            setPublicationMatches(prevMatches => [...prevMatches, ...batch]);
+            setIsLoading(false);
+          }
+        }
       } catch (error) {
-        console.error('Matching failed:', error);
+        if (error.name !== 'AbortError') {
+          console.error('Matching failed:', error);
+        }
       } finally {
-        setIsLoading(false);
+        if (!controller.signal.aborted) {
+          setIsLoading(false);
+        }
       }
     };
 
     fetchMatches();
+    return () => controller.abort();
   }, [matchingStrategy, similarityThreshold]);
 
   const handleValidationChange = async (candidateId, isValid) => {
@@ -51,6 +81,31 @@ const PublicationMatcher = () => {
     }
   };
 
+  // Validate every candidate of a Flora publication with a single bulk request
+  const handleAcceptAll = async (candidates) => {
+    try {
+      const response = await axios.put('http://localhost:5000/api/publications/validate',
+        candidates.map(candidate => ({ id: candidate.id, isValid: true }))
+      );
+      const accepted = new Set(response.data.results
+        .filter(result => result.status === 'updated')
+        .map(result => result.id));
+
+      setPublicationMatches(prevMatches =>
+        prevMatches.map(match => ({
+          ...match,
+          matching_candidates: match.matching_candidates.map(candidate =>
+            accepted.has(candidate.id)
+              ? { ...candidate, isValid: true }
+              : candidate
+          )
+        }))
+      );
+    } catch (error) {
+      console.error('Failed to accept candidates:', error);
+    }
+  };
+
   const handleCommentChange = async (candidateId, comment) => {
     try {
       await axios.put(`http://localhost:5000/api/publications/${encodeURIComponent(candidateId)}/validate`, { 
@@ -135,6 +190,11 @@ const PublicationMatcher = () => {
 
               <div className="matching-candidates">
                 <h4>Matching Candidates</h4>
+                {match.matching_candidates.length > 1 && (
+                  <button onClick={() => handleAcceptAll(match.matching_candidates)}>
+                    Accept all candidates
+                  </button>
+                )}
                 {match.matching_candidates.length > 0 ? (
                   <table border="1" cellPadding="8" style={{ width: '100%', borderCollapse: 'collapse' }}>
                     <thead>
@@ -0,0 +1,16 @@
+from models import SyncState, utcnow
+
+
+def get_watermark(session, source, query_key):
+    """Watermark stored by the last complete sync of `source` for `query_key`, or None."""
+    state = session.get(SyncState, (source, query_key))
+    return state.watermark if state is not None else None
+
+def set_watermark(session, source, query_key, watermark):
+    """Store the watermark reached by a sync, in the caller's transaction."""
+    state = session.get(SyncState, (source, query_key))
+    if state is None:
+        state = SyncState(source=source, query_key=query_key)
+        session.add(state)
+    state.watermark = watermark
+    state.synced_at = utcnow()